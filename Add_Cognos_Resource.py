@@ -26,4 +26,5 @@ else:
     os.environ['http_proxy'] = http_proxy
     my_log.info("Set proxy to %s", http_proxy)
 fh.add_cognos_resources()
+fh.ds.close_connection()
 my_log.info("End Application")
@@ -0,0 +1,28 @@
+#!/opt/csw/bin/python3
+
+"""
+This script will make a backup of the database while other scripts keep working on it. The backup is written to
+directory backupdir (section Main, default the directory of the database) with the date and time in the filename.
+Set backup_compress = off in section Main for an uncompressed backup.
+Reporting jobs can open the backup as a read-only Datastore with Datastore.open_snapshot(config, filename).
+"""
+import os
+from Datastore import Datastore
+from lib import my_env
+from time import strftime
+
+# Initialize Environment
+projectname = "vea_od"
+modulename = my_env.get_modulename(__file__)
+config = my_env.get_inifile(projectname, __file__)
+my_log = my_env.init_loghandler(config, modulename)
+my_log.info('Start Application')
+db = config['Main']['db']
+backupdir = config['Main'].get('backupdir', os.path.dirname(os.path.abspath(db)))
+compress = config['Main'].get('backup_compress', 'on').lower() in ['on', 'true', 'yes', '1']
+(db_name, db_ext) = os.path.splitext(os.path.basename(db))
+backup_file = os.path.join(backupdir, db_name + "_" + strftime("%Y%m%d_%H%M%S") + db_ext)
+ds = Datastore(config, write_behind=False)
+ds.backup(backup_file, compress)
+ds.close_connection()
+my_log.info("End Application")
@@ -2,6 +2,7 @@
 
 import logging
 import sys
+import time
 import ckanapi
 from lib import my_env
 
@@ -95,30 +96,34 @@ class CKANConnector:
         logging.info(log_msg, indic_id)
         return True
 
-    def update_package(self, indic_id):
+    def update_package(self, indic_id, snapshot=None):
         """
         This procedure will update Package information for the indicator ID.
         :param indic_id:
-        :return:
+        :param snapshot: Dictionary with all attribute / value pairs for the indicator (get_indicator_snapshot). If
+        not specified, then the attributes are read from the datastore.
+        :return: True if the package update was successful, False otherwise.
         """
         log_msg = "Update Package for Indicator %s"
         logging.info(log_msg, indic_id)
+        if snapshot is None:
+            # Get all attributes for the indicator in one query.
+            snapshot = self.ds.get_indicator_snapshot(indic_id).get(indic_id, {})
         # Get Open Data ID of the package
-        res = self.ds.get_indicator_value(indic_id, 'id')
-        dataset_id = res[0][0]  # Remember ID of the package in params dictionary. First element in first array is id.
+        dataset_id = snapshot['id']
         logging.debug("Dataset ID: %s", dataset_id)
         # First check if there is a 'cijfersXML' URL available.
         # If not, then set dataset to private.
-        if self.check_resource(indic_id, 'cijfersxml'):
-            self.set_pkg_public(indic_id, dataset_id)
+        if 'url_cijfersxml' in snapshot:
+            return self.set_pkg_public(indic_id, dataset_id, snapshot)
         else:
-            self.set_pkg_private(dataset_id)
+            return self.set_pkg_private(dataset_id)
 
     def set_pkg_private(self, dataset_id):
         """
         This indicator does not have a cijfersxml file associated or metadata filename has empty, set it to 'private'.
         :param dataset_id: ID of the dataset on Open Data platform.
-        :return:
+        :return: True if the package update was successful, False otherwise.
         """
         params = {
             'id': dataset_id,
@@ -133,19 +138,24 @@ class CKANConnector:
             ec = sys.exc_info()[0]
             log_msg = "Package Update not successful %s %s"
             logging.error(log_msg, e, ec)
+            return False
         else:
             log_msg = "Package Update successful %s"
             logging.info(log_msg, pkg)
-        return
+        return True
 
-    def set_pkg_public(self, indic_id, dataset_id):
+    def set_pkg_public(self, indic_id, dataset_id, snapshot=None):
         """
         This Indicator has a cijfer file available, so dataset can be published as Public on Open Data Platform.
         :param indic_id: Indicator ID
         :param dataset_id: ID of dataset on Open Data platform.
-        :return:
+        :param snapshot: Dictionary with all attribute / value pairs for the indicator (get_indicator_snapshot). If
+        not specified, then the attributes are read from the datastore.
+        :return: True if the package update was successful, False otherwise.
         """
         logging.debug("Setting package for indicator " + str(indic_id) + " public.")
+        if snapshot is None:
+            snapshot = self.ds.get_indicator_snapshot(indic_id).get(indic_id, {})
         params = {
             "id": dataset_id,
             "private": False,
@@ -155,38 +165,24 @@ class CKANConnector:
         target = "Dataset"
         action = "Extra"
         res = self.ds.get_attrib_od_pairs(source, target, action)
-        # Remember the attribute - od_field translation
-        od_field = {}
-        for [k, v] in res:
-            od_field[k] = v
-        # Then get values for the attribute names
-        # Collect all unique attribute names in array attribs first.
-        attribs = [res[i][0] for i in range(len(res))]
-        # For all attribute names find corresponding value in indicators table
-        res = self.ds.get_indicator_attrib_values(indic_id, attribs)
+        # For all attribute names find corresponding value in the indicator snapshot
         extra_arr = []
         for [k, v] in res:
-            attrib_dict = {
-                "key": od_field[k],  # Use human readable label as key
-                "value": v
-            }
-            extra_arr.append(attrib_dict)
+            if k in snapshot:
+                attrib_dict = {
+                    "key": v,  # Use human readable label as key
+                    "value": snapshot[k]
+                }
+                extra_arr.append(attrib_dict)
         # Add extras dictionary to params dictionary
         params["extras"] = extra_arr
         # Then get attribute names for Main fields
         action = "Main"
         res = self.ds.get_attrib_od_pairs(source, target, action)
-        # Remember the attribute - od_field translation for Main field
-        od_field = {}
-        for [k, v] in res:
-            od_field[k] = v
-        # Then get values for the Main attribute names
-        attribs = [res[i][0] for i in range(len(res))]
-        # With attribute names, find corresponding values in indicators table
-        res = self.ds.get_indicator_attrib_values(indic_id, attribs)
-        # Add the values to params dictionary
+        # With attribute names, find corresponding values in the indicator snapshot and add to params dictionary
         for [k, v] in res:
-            params[od_field[k]] = v
+            if k in snapshot:
+                params[v] = snapshot[k]
         log_msg = "Trying to update package with params %s"
         logging.debug(log_msg, params)
         try:
@@ -196,16 +192,55 @@ class CKANConnector:
             ec = sys.exc_info()[0]
             log_msg = "Package Update not successful %s %s"
             logging.error(log_msg, e, ec)
-            return
+            return False
         log_msg = "Package Update successful for indicator ID %s, now update resources."
         logging.info(log_msg, indic_id)
         # Check all resource types
         # I know for sure that the cijfersXML_ind.xml is on the FTP server, so check will always return TRUE.
         res_types = my_env.get_resource_types()
         for res_type in res_types:
-            if self.check_resource(indic_id, res_type):
-                self.manage_resource(indic_id, dataset_id, res_type)
-        return
+            if "url_" + res_type in snapshot:
+                self.manage_resource(indic_id, dataset_id, res_type, snapshot)
+        return True
+
+    def sync_changed_packages(self):
+        """
+        This method will update the packages on Open Data platform for all indicators that have changed since the last
+        successful synchronization (incremental sync). Indicators without package ID are skipped, the package is created
+        when the metadata file is handled.
+        The watermark is set only if all package updates are successful. Otherwise the next run will try all changed
+        indicators again. The package and resource IDs that the sync writes mark the synced indicators as changed, so
+        the watermark is taken after these writes (at the next full second). If other indicators changed during the
+        sync, the watermark is the start time of this run and these indicators are handled in the next run. A change of
+        a synced indicator by another process during its package update is not detected.
+        :return: True if all package updates were successful, False otherwise.
+        """
+        sync_target = 'ckan'
+        start = int(time.time())
+        since = self.ds.get_sync_watermark(sync_target)
+        dirty_indics = self.ds.get_dirty_indicators(since)
+        log_msg = "%s indicators changed since %s"
+        logging.info(log_msg, len(dirty_indics), since)
+        snapshot = self.ds.get_indicator_snapshot(dirty_indics)
+        all_ok = True
+        for indic_id in dirty_indics:
+            if 'id' not in snapshot.get(indic_id, {}):
+                logging.debug("No package for indicator %s, skipped.", indic_id)
+            elif not self.update_package(indic_id, snapshot[indic_id]):
+                all_ok = False
+        if all_ok:
+            # Wait for the next full second, so all writes of the sync have a change time before the watermark.
+            end = int(time.time()) + 1
+            time.sleep(max(end - time.time(), 0))
+            others = set(self.ds.get_dirty_indicators(start)) - set(dirty_indics)
+            if others:
+                log_msg = "%s other indicators changed during the sync, watermark is start of the sync."
+                logging.info(log_msg, len(others))
+                end = start
+            self.ds.set_sync_watermark(sync_target, end)
+        else:
+            logging.error("Not all packages are updated, watermark remains %s", since)
+        return all_ok
 
     def check_dataset(self, indic_id):
         """
@@ -251,7 +286,7 @@ class CKANConnector:
             logging.error(log_msg, res_type, indic_id)
             return False
 
-    def manage_resource(self, indic_id, dataset_id, res_type):
+    def manage_resource(self, indic_id, dataset_id, res_type, snapshot=None):
         """
         This function will manage the resource patch. Check if cijfer resource or commentaar resource needs to be
         created or updated.
@@ -260,9 +295,13 @@ class CKANConnector:
         :param indic_id: Indicator ID that is currently being processed.
         :param dataset_id: Package ID of the package that is currently handled.
         :param res_type: Type of the resource.
+        :param snapshot: Dictionary with all attribute / value pairs for the indicator (get_indicator_snapshot). If
+        not specified, then the attributes are read from the datastore.
         :return: nothing
         """
         logging.debug("Managing resource: " + str(indic_id) + " for package " + str(dataset_id))
+        if snapshot is None:
+            snapshot = self.ds.get_indicator_snapshot(indic_id).get(indic_id, {})
         params = {
             'package_id': dataset_id,
         }
@@ -272,38 +311,24 @@ class CKANConnector:
         target = my_env.get_target(res_type)
         action = 'Resource'
         res = self.ds.get_attrib_od_pairs(source, target, action)
-        # Remember the attribute - od_field translation for Main field
-        od_field = {}
-        for [k, v] in res:
-            od_field[k] = v
-        # Then get values for these Resource attribute names
-        attribs = [res[i][0] for i in range(len(res))]
-        # With attribute names, find corresponding values in indicators table
-        res = self.ds.get_indicator_attrib_values(indic_id, attribs)
-        # Add the values with Open Data Keys to params dictionary
+        # Add the values from the indicator snapshot with Open Data Keys to params dictionary
         for [k, v] in res:
-            params[od_field[k]] = v
+            if k in snapshot:
+                params[v] = snapshot[k]
         # Now check if this is a new resource or an update for a resource
         id_name = "id_" + res_type
-        res = self.ds.get_indicator_value(indic_id, id_name)
+        resource_id = snapshot.get(id_name)
         log_msg = "Result for id_name %s: %s"
-        logging.debug(log_msg, id_name, res)
-        log_msg = "Length: %s"
-        logging.debug(log_msg, len(res))
-        if len(res) == 0:
+        logging.debug(log_msg, id_name, resource_id)
+        if resource_id is None:
             # Resource_Create
             self.create_resource(indic_id, params, res_type)
-        elif len(res) == 1:
-            # Check if resource still exists. In case of Cognos, resource can be removed
-            resource_id = res[0][0]
-            if self.verify_resource(resource_id):
-                params['id'] = res[0][0]  # Resource ID exists.
-                self.update_resource(indic_id, params)
-            else:
-                self.create_resource(indic_id, params, res_type)   # Resource didn't exist, remove...
+        # Check if resource still exists. In case of Cognos, resource can be removed
+        elif self.verify_resource(resource_id):
+            params['id'] = resource_id  # Resource ID exists.
+            self.update_resource(indic_id, params)
         else:
-            log_msg = "Unexpected number of Resource record IDs for indicator ID %s and resource %s"
-            logging.error(log_msg, indic_id, res_type)
+            self.create_resource(indic_id, params, res_type)   # Resource didn't exist, remove...
         return
 
     def create_resource(self, indic_id, params, res_type):
@@ -335,7 +360,7 @@ class CKANConnector:
         else:
             # Store resource ID in indicators table
             attribute = "id_" + res_type
-            self.ds.insert_indicator(indic_id, attribute, val_id)
+            self.ds.upsert_indicator_attributes(indic_id, {attribute: val_id})
         log_msg = 'Looks like I have my %s Resource...'
         logging.info(log_msg, res_type)
         return
@@ -8,41 +8,298 @@ attribute_action table is generic over all indicators.
 The second part is the indicator table. This is the Open Data information related to the individual indicator. In a
 future release, this indicator table should be replaced by the json information that is collected from the Open Data
 website. This will remove the need to maintain data locally - on more that one place so more risk on errors.
-An instance of the class will create a database handle and a cursor to the database.
+The indicator information is stored in table indicator_values, with the attribute_action ID instead of the attribute
+name. View indicators shows the records with attribute name. The methods of this class use attribute names.
+An instance of the class will create a database handle and a cursor to the database. On connect, pending schema
+upgrades (indexes, new columns, ...) are applied to the database. The schema version is kept in PRAGMA user_version.
+Optionally the attributes of the most recently used indicators are kept in memory: set cache_size in section Main of
+the ini file to the number of indicators to cache.
+Catalog default attributes (same value for all indicators, from section OpenData in the ini file) and derived
+attributes (resource names from title, notes from Definitie) are not stored for each indicator. They are resolved
+when the indicator attributes are read.
+In write-behind mode the database is copied in memory and all reads and writes use the memory copy. Changes are
+written to the database file at checkpoints and when the connection is closed (also at exit of the script).
+Method backup makes an online copy of the database, open_snapshot opens such a copy read-only for reporting.
+Reporting scripts use read-only mode: the database file is opened read-only or copied into memory, so they don't
+compete with the pipeline for the write lock.
 """
 
+import atexit
+import configparser
+import gzip
 import logging
+import os
+import shutil
 import sqlite3
 import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 from lib import my_env
-from time import strftime
+from lib.timing import TimingStats
+from pathlib import Path
+from time import strftime, time as epoch_now
+from types import MappingProxyType
+
+
+def timed(method):
+    """
+    Decorator for the Datastore methods that are timed when query timing is on (see Datastore.__init__). The execution
+    time is recorded with the method name. A call that takes longer than the slow query threshold is logged with the
+    query plan of the SQL statements it executed.
+    Only the outermost timed call is recorded: the time of a timed method that is called by another timed method
+    (e.g. upsert_indicators called by insert_indicator) is part of the time of the calling method.
+    :param method: Datastore method.
+    :return: Wrapped method.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        depth = getattr(self.local, 'timing_depth', 0)
+        if self.timing is None or depth > 0:
+            return method(self, *args, **kwargs)
+        trace = self._get_trace()
+        del trace[:]
+        self.local.timing_depth = 1
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            self.local.timing_depth = 0
+            self.timing.record(method.__name__, duration)
+            if duration >= self.slow_query:
+                self._log_slow_query(method.__name__, duration, list(trace))
+    return wrapper
+
+
+class ConsistencyReport(namedtuple('ConsistencyReport', ['orphan_attributes', 'duplicate_attributes'])):
+    """
+    Result of Datastore.db_consistency.
+    orphan_attributes: list of (attribute, number of indicator records) for attributes in indicators table that are
+    not registered in attribute_action table.
+    duplicate_attributes: list of (attribute, count) for attributes that occur more than once in attribute_action.
+    """
+
+    def is_consistent(self):
+        """
+        :return: True if no problems are found, False otherwise.
+        """
+        return not (self.orphan_attributes or self.duplicate_attributes)
 
 
 class Datastore:
 
-    def __init__(self, config):
+    # Statements that are executed for every indicator. The sqlite3 statement cache of a connection uses the statement
+    # text as key, so these statements are always executed with the same text. {in_list} is replaced by the
+    # placeholders from method _in_list, which has a limited number of different lengths.
+    statements = {
+        'indicator_value': "SELECT value FROM indicators WHERE indicator_id = ? and attribute = ?",
+        'indicator_attrib_values': "SELECT attribute, value FROM indicators "
+                                   "WHERE indicator_id = ? AND attribute IN ({in_list})",
+        'snapshot': "SELECT indicator_id, attribute_id, value FROM indicator_values",
+        'snapshot_ids': "SELECT indicator_id, attribute_id, value FROM indicator_values "
+                        "WHERE indicator_id IN ({in_list})",
+        'timestamps': "SELECT v.indicator_id, coalesce(min(c.first_seen), min(v.created_epoch)), "
+                      "max(v.created_epoch) FROM indicator_values v "
+                      "LEFT JOIN indicator_changes c ON c.indicator_id = v.indicator_id "
+                      "GROUP BY v.indicator_id",
+        'timestamps_ids': "SELECT v.indicator_id, coalesce(min(c.first_seen), min(v.created_epoch)), "
+                          "max(v.created_epoch) FROM indicator_values v "
+                          "LEFT JOIN indicator_changes c ON c.indicator_id = v.indicator_id "
+                          "WHERE v.indicator_id IN ({in_list}) GROUP BY v.indicator_id",
+        'upsert_value': "INSERT INTO indicator_values (indicator_id, attribute_id, value, created_epoch) "
+                        "VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (indicator_id, attribute_id) DO UPDATE SET value = excluded.value, "
+                        "created_epoch = excluded.created_epoch "
+                        "WHERE value IS NOT excluded.value",
+        'remove_value': "DELETE FROM indicator_values WHERE indicator_id = ? AND attribute_id = ?",
+        'dirty_indicators': "SELECT indicator_id FROM indicator_changes WHERE changed >= ? ORDER BY indicator_id",
+        'get_watermark': "SELECT watermark FROM sync_state WHERE target = ?",
+        'set_watermark': "INSERT OR REPLACE INTO sync_state (target, watermark) VALUES (?, ?)",
+        'get_manifest': "SELECT sha256, size, mtime FROM file_manifest WHERE filename = ?",
+        'set_manifest': "INSERT OR REPLACE INTO file_manifest (filename, sha256, size, mtime, published_epoch) "
+                        "VALUES (?, ?, ?, ?, ?)",
+        'remove_manifest': "DELETE FROM file_manifest WHERE filename = ?",
+        'set_intake_state': "INSERT OR REPLACE INTO intake_journal "
+                            "(filename, indicator_id, state, sha256, size, mtime, updated_epoch) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        'remove_intake': "DELETE FROM intake_journal WHERE filename = ?",
+        'register_intake': "INSERT OR IGNORE INTO intake_journal "
+                           "(filename, indicator_id, state, sha256, size, mtime, updated_epoch) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        'open_intake': "SELECT filename, indicator_id, state, sha256, size, mtime FROM intake_journal "
+                       "ORDER BY filename",
+    }
+    # Maximum number of values in an IN list, stay below the maximum number of host parameters in a query (999 for
+    # older SQLite versions).
+    max_in_list = 512
+
+    def __init__(self, config, write_behind=None, read_only=False):
         """
         Method to instantiate the class in an object for the datastore.
+        Each thread that uses the object gets its own database connection, taken from a small pool. Connection options
+        are read from section Main in the ini file: journal_mode (e.g. wal, default is the SQLite default),
+        busy_timeout (seconds to wait for a lock, default 30), busy_retries (number of retries when the database
+        remains locked, default 3), pool_size (number of idle connections to keep, default 4) and cached_statements
+        (size of the statement cache of each connection, default 256).
+        Set query_timing to on to collect execution times per Datastore method, calls that take more than
+        slow_query_ms milliseconds (default 100) are logged with their query plan. A summary is logged on
+        close_connection.
         :param config object, to get connection parameters.
+        :param write_behind: True to work on a memory copy of the database (see write-behind methods), False to work on
+        the database file. Default is option write_behind in section Main of the ini file (on / off, default off).
+        The interval in seconds between automatic checkpoints is option checkpoint_interval (default 300).
+        :param read_only: True for scripts that only read the datastore. The database file is opened read-only, or
+        copied into memory if option read_only_copy in section Main is on (default off). Use the memory copy if the
+        database is not in wal mode: a long read on the file would block the commits of the pipeline. Schema upgrades
+        are not applied in read-only mode.
         :return: Object to handle datastore commands.
         """
         logging.debug("Initializing Datastore object")
         self.config = config
-        self.dbConn, self.cur = self._connect2db()
+        self.journal_mode = self.config['Main'].get('journal_mode', '')
+        self.busy_timeout = float(self.config['Main'].get('busy_timeout', '30'))
+        self.busy_retries = int(self.config['Main'].get('busy_retries', '3'))
+        self.pool_size = int(self.config['Main'].get('pool_size', '4'))
+        self.cached_statements = int(self.config['Main'].get('cached_statements', '256'))
+        # Optional query timing, see decorator timed. Calls that take at least slow_query seconds are logged.
+        if self.config['Main'].get('query_timing', 'off').lower() in ['on', 'true', 'yes', '1']:
+            self.timing = TimingStats()
+        else:
+            self.timing = None
+        self.slow_query = float(self.config['Main'].get('slow_query_ms', '100')) / 1000
+        # Connection per thread. The thread-local object has the connection, the cursor, the transaction depth and the
+        # PRAGMA data_version that was last seen on the connection.
+        self.local = threading.local()
+        # Connections in use by threads (thread - connection pairs) and idle connections.
+        self.pool_lock = threading.Lock()
+        self.conn_in_use = []
+        self.conn_idle = []
+        # Cache of the attribute_action table, see _get_attrib_map. The table changes only when BuildDatabase.py runs.
+        self.attrib_map = None
+        # Optional LRU cache of indicator attributes, see _get_cached_indicators.
+        self.cache_size = int(self.config['Main'].get('cache_size', '0'))
+        self.indic_cache = OrderedDict()
+        self.cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.cache_lock = threading.RLock()
+        # Catalog default attributes and derived attributes, resolved at read time.
+        try:
+            self.catalog_defaults = {attribute: self.config['OpenData'][attribute]
+                                     for attribute in my_env.get_catalog_default_attribs()}
+        except KeyError:
+            logging.warning("Catalog default attributes not found in section OpenData.")
+            self.catalog_defaults = {}
+        self.derived_attribs = my_env.get_derived_attribs()
+        # URI of the database (read-only file or memory copy), None to use the database file. The memory copy stays
+        # available as long as connection mem_anchor is open.
+        self.db_uri = None
+        self.mem_anchor = None
+        self.write_behind = False
+        self.read_only = read_only
+        if self.read_only:
+            self.db_uri = Path(self.config['Main']['db']).resolve().as_uri() + "?mode=ro"
+        self._upgrade_db()
+        if self.read_only:
+            if self.config['Main'].get('read_only_copy', 'off').lower() in ['on', 'true', 'yes', '1']:
+                self._load_memory_copy()
+            return
+        if write_behind is None:
+            write_behind = self.config['Main'].get('write_behind', 'off').lower() in ['on', 'true', 'yes', '1']
+        if write_behind:
+            self._start_write_behind()
+        return
+
+    @property
+    def dbConn(self):
+        """
+        Database connection for the current thread.
+        :return: Database handle.
+        """
+        if getattr(self.local, 'conn', None) is None:
+            self._get_connection()
+        return self.local.conn
+
+    @property
+    def cur(self):
+        """
+        Database cursor for the current thread.
+        :return: Database cursor.
+        """
+        if getattr(self.local, 'conn', None) is None:
+            self._get_connection()
+        return self.local.cur
+
+    def _get_connection(self):
+        """
+        Internal method to assign a connection to the current thread. A connection that is no longer used (released,
+        or its thread has finished) is taken from the pool, otherwise a new connection is created.
+        :return:
+        """
+        with self.pool_lock:
+            # Connections of threads that have finished go back to the pool.
+            for thread, conn in list(self.conn_in_use):
+                if not thread.is_alive():
+                    self.conn_in_use.remove((thread, conn))
+                    self.conn_idle.append(conn)
+            if self.conn_idle:
+                db_conn = self.conn_idle.pop()
+            else:
+                db_conn, db_cur = self._connect2db()
+            self.conn_in_use.append((threading.current_thread(), db_conn))
+        self.local.conn = db_conn
+        self.local.cur = db_conn.cursor()
+        self.local.trans_depth = 0
+        self.local.data_version = None
+        return
+
+    def release_connection(self):
+        """
+        Method to return the connection of the current thread to the pool. A worker thread should call this method
+        when it is done with the datastore. Idle connections above pool_size are closed.
+        :return:
+        """
+        db_conn = getattr(self.local, 'conn', None)
+        if db_conn is None:
+            return
+        self.local.conn = None
+        with self.pool_lock:
+            self.conn_in_use.remove((threading.current_thread(), db_conn))
+            if len(self.conn_idle) < self.pool_size:
+                self.conn_idle.append(db_conn)
+                return
+        db_conn.close()
         return
 
     def _connect2db(self):
         """
-        Internal method to create a database connection and a cursor. This method is called during object
-        initialization.
+        Internal method to create a database connection and a cursor. This method is called when a thread needs a
+        connection and no idle connection is available in the pool.
         Note that sqlite connection object does not test the Database connection. If database does not exist, this
         method will not fail. This is expected behaviour, since it will be called to create databases as well.
+        The connection is in autocommit mode, transactions are started explicitly in method transaction(). The
+        connection can move to another thread when it is returned to the pool, but it is used by one thread at a time.
         :return: Database handle and cursor for the database.
         """
         logging.debug("Creating Datastore object and cursor")
         db = self.config['Main']['db']
         try:
-            db_conn = sqlite3.connect(db)
+            if self.db_uri:
+                db_conn = sqlite3.connect(self.db_uri, timeout=self.busy_timeout, isolation_level=None,
+                                          check_same_thread=False, cached_statements=self.cached_statements, uri=True)
+                if self.mem_anchor is not None:
+                    # Shared cache uses table locks that do not wait. Readers don't lock, writers use write_lock.
+                    db_conn.execute("PRAGMA read_uncommitted = 1")
+            else:
+                db_conn = sqlite3.connect(db, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False,
+                                          cached_statements=self.cached_statements)
+            if self.timing is not None:
+                db_conn.set_trace_callback(self._trace_statement)
+            if self.read_only:
+                db_conn.execute("PRAGMA query_only = 1")
+            elif self.journal_mode and not self.db_uri:
+                db_conn.execute("PRAGMA journal_mode = {m}".format(m=self.journal_mode))
         except:
             e = sys.exc_info()[1]
             ec = sys.exc_info()[0]
@@ -53,26 +310,502 @@ class Datastore:
             logging.debug("Datastore object and cursor are created")
             return db_conn, db_conn.cursor()
 
+    def _retry_busy(self, func, *args):
+        """
+        Internal method to call a database function, retrying when the database is locked. The connection already waits
+        busy_timeout seconds for a lock, so a retry is done only when another process keeps a lock for a long time.
+        :param func: Function to call.
+        :param args: Arguments for the function.
+        :return: Result of the function.
+        """
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except sqlite3.OperationalError:
+                e = sys.exc_info()[1]
+                if attempt >= self.busy_retries or not ('locked' in str(e) or 'busy' in str(e)):
+                    raise
+                attempt += 1
+                log_msg = "Database is locked, retry %s of %s"
+                logging.warning(log_msg, attempt, self.busy_retries)
+                time.sleep(attempt)
+
+    def _upgrade_db(self):
+        """
+        Internal method to bring the database schema to the latest version. Each upgrade step is applied in its own
+        transaction and sets PRAGMA user_version to the step number, so steps run only once. Nothing is done if the
+        tables have not been created yet (BuildDatabase.py).
+        :return:
+        """
+        upgrades = [self._upgrade_v1, self._upgrade_v2, self._upgrade_v3, self._upgrade_v4, self._upgrade_v5,
+                    self._upgrade_v6, self._upgrade_v7, self._upgrade_v8]
+        query = "SELECT count(*) FROM sqlite_master " \
+                "WHERE type IN ('table', 'view') AND name IN ('indicators', 'attribute_action')"
+        if self.dbConn.execute(query).fetchone()[0] < 2:
+            logging.debug("Tables not yet created, no schema upgrade.")
+            return
+        version = self.dbConn.execute("PRAGMA user_version").fetchone()[0]
+        if self.read_only:
+            if version < len(upgrades):
+                logging.error("Database schema version is %s, run a read-write script to upgrade the schema.", version)
+            return
+        for step in range(version, len(upgrades)):
+            logging.info("Upgrade database schema to version %s", step + 1)
+            try:
+                with self.transaction():
+                    upgrades[step]()
+                    self.dbConn.execute("PRAGMA user_version = {v}".format(v=step + 1))
+            except:
+                e = sys.exc_info()[1]
+                ec = sys.exc_info()[0]
+                log_msg = "Error during database schema upgrade: %s %s"
+                logging.critical(log_msg, e, ec)
+                sys.exit(1)
+        return
+
+    def _upgrade_v1(self):
+        """
+        Schema version 1: unique index on indicators (indicator_id, attribute) and index on attribute_action (source,
+        target, action). Duplicate indicator / attribute records are removed first, the most recent record is kept.
+        :return:
+        """
+        query = "DELETE FROM indicators WHERE id NOT IN " \
+                "(SELECT max(id) FROM indicators GROUP BY indicator_id, attribute)"
+        self.dbConn.execute(query)
+        self.dbConn.execute("CREATE UNIQUE INDEX IF NOT EXISTS indicators_indic_attrib "
+                            "ON indicators (indicator_id, attribute)")
+        self.dbConn.execute("CREATE INDEX IF NOT EXISTS attribute_action_action "
+                            "ON attribute_action (source, target, action)")
+        return
+
+    def _upgrade_v2(self):
+        """
+        Schema version 2: change journal. Table indicator_changes has the time (epoch seconds) of the last change for
+        each indicator. Triggers on the indicators table keep the journal up-to-date for every insert, value update
+        and delete. Table sync_state has the watermark (epoch seconds) of the last successful synchronization for
+        each target.
+        :return:
+        """
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS indicator_changes "
+                            "(indicator_id integer primary key, changed integer)")
+        self.dbConn.execute("CREATE INDEX IF NOT EXISTS indicator_changes_changed ON indicator_changes (changed)")
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS sync_state (target text primary key, watermark integer)")
+        self._create_journal_triggers('indicators')
+        # Existing indicators are dirty, the first synchronization will handle all indicators.
+        self.dbConn.execute("INSERT OR IGNORE INTO indicator_changes (indicator_id, changed) "
+                            "SELECT DISTINCT indicator_id, CAST(strftime('%s', 'now') AS integer) FROM indicators")
+        return
+
+    def _create_journal_triggers(self, table, first_seen=False):
+        """
+        Internal method to create the triggers that keep the indicator_changes journal up-to-date.
+        :param table: Table with the indicator records.
+        :param first_seen: If True, the journal record is created with the first_seen time (schema version 8).
+        :return:
+        """
+        # No INSERT OR REPLACE in the triggers: the conflict clause of the outer statement (upsert in
+        # upsert_indicators) would override it. Insert the journal record if it does not exist, then update it.
+        if first_seen:
+            insert = "INSERT INTO indicator_changes (indicator_id, changed, first_seen) " \
+                     "SELECT {row}.indicator_id, 0, CAST(strftime('%s', 'now') AS integer) "
+        else:
+            insert = "INSERT INTO indicator_changes (indicator_id, changed) " \
+                     "SELECT {row}.indicator_id, 0 "
+        journal = insert + \
+                  "WHERE NOT EXISTS (SELECT 1 FROM indicator_changes WHERE indicator_id = {row}.indicator_id); " \
+                  "UPDATE indicator_changes SET changed = CAST(strftime('%s', 'now') AS integer) " \
+                  "WHERE indicator_id = {row}.indicator_id"
+        self.dbConn.execute("CREATE TRIGGER IF NOT EXISTS {t}_journal_insert AFTER INSERT ON {t} "
+                            "BEGIN ".format(t=table) + journal.format(row='NEW') + "; END")
+        self.dbConn.execute("CREATE TRIGGER IF NOT EXISTS {t}_journal_update AFTER UPDATE ON {t} "
+                            "WHEN OLD.value IS NOT NEW.value "
+                            "BEGIN ".format(t=table) + journal.format(row='NEW') + "; END")
+        self.dbConn.execute("CREATE TRIGGER IF NOT EXISTS {t}_journal_delete AFTER DELETE ON {t} "
+                            "BEGIN ".format(t=table) + journal.format(row='OLD') + "; END")
+        return
+
+    def _upgrade_v3(self):
+        """
+        Schema version 3: sortable timestamp. Column created_epoch (epoch seconds) with an index is added to the
+        indicators and attribute_action tables. Existing rows get created_epoch from the created string
+        ("%H:%M:%S %d-%m-%Y", local time).
+        :return:
+        """
+        to_epoch = "UPDATE {t} SET created_epoch = CAST(strftime('%s', substr(created, 16, 4) || '-' || " \
+                   "substr(created, 13, 2) || '-' || substr(created, 10, 2) || ' ' || substr(created, 1, 8), " \
+                   "'utc') AS integer) WHERE length(created) = 19"
+        for table in ['indicators', 'attribute_action']:
+            columns = [row[1] for row in self.dbConn.execute("PRAGMA table_info({t})".format(t=table))]
+            if 'created_epoch' not in columns:
+                self.dbConn.execute("ALTER TABLE {t} ADD COLUMN created_epoch integer".format(t=table))
+            self.dbConn.execute(to_epoch.format(t=table))
+            self.dbConn.execute("CREATE INDEX IF NOT EXISTS {t}_created_epoch ON {t} (created_epoch)".format(t=table))
+        return
+
+    def _upgrade_v4(self):
+        """
+        Schema version 4: compact indicator records. Table indicator_values refers to attribute_action by integer ID
+        instead of attribute name, and the value column has no type affinity so values keep their natural type (file
+        sizes are integers). The created string is replaced by created_epoch. Table indicators is replaced by a view
+        with the same columns, so read queries on indicators continue to work.
+        Attributes in indicators that are not in attribute_action are added to attribute_action without source,
+        target and action.
+        Run VACUUM afterwards to reclaim the space of the old table.
+        :return:
+        """
+        self.dbConn.execute("INSERT INTO attribute_action (attribute, created, created_epoch) "
+                            "SELECT DISTINCT attribute, strftime('%H:%M:%S %d-%m-%Y', 'now', 'localtime'), "
+                            "CAST(strftime('%s', 'now') AS integer) FROM indicators "
+                            "WHERE attribute NOT IN (SELECT attribute FROM attribute_action)")
+        self.dbConn.execute("CREATE TABLE indicator_values "
+                            "(id integer primary key, indicator_id integer not null, "
+                            "attribute_id integer not null, value, created_epoch integer, "
+                            "FOREIGN KEY(attribute_id) REFERENCES attribute_action(id))")
+        self.dbConn.execute("INSERT INTO indicator_values (id, indicator_id, attribute_id, value, created_epoch) "
+                            "SELECT i.id, i.indicator_id, a.id, "
+                            "CASE WHEN i.attribute LIKE 'size!_%' ESCAPE '!' AND i.value NOT GLOB '*[^0-9]*' "
+                            "AND i.value <> '' THEN CAST(i.value AS integer) ELSE i.value END, "
+                            "i.created_epoch "
+                            "FROM indicators i JOIN attribute_action a ON a.attribute = i.attribute")
+        self.dbConn.execute("DROP TABLE indicators")
+        self.dbConn.execute("CREATE UNIQUE INDEX indicator_values_indic_attrib "
+                            "ON indicator_values (indicator_id, attribute_id)")
+        self.dbConn.execute("CREATE INDEX indicator_values_attrib ON indicator_values (attribute_id)")
+        self.dbConn.execute("CREATE INDEX indicator_values_created_epoch ON indicator_values (created_epoch)")
+        self.dbConn.execute("CREATE VIEW indicators AS "
+                            "SELECT v.id, v.indicator_id, a.attribute, v.value, "
+                            "strftime('%H:%M:%S %d-%m-%Y', v.created_epoch, 'unixepoch', 'localtime') AS created, "
+                            "v.created_epoch "
+                            "FROM indicator_values v JOIN attribute_action a ON a.id = v.attribute_id")
+        self._create_journal_triggers('indicator_values')
+        return
+
+    def _upgrade_v5(self):
+        """
+        Schema version 5: catalog default and derived attributes are no longer stored for each indicator. Stored
+        default attributes are removed, so the values from the ini file are used. Stored derived attributes are
+        removed if they have the value that is calculated at read time.
+        :return:
+        """
+        attrib_ids = self._get_attrib_map()['ids']
+        query = "DELETE FROM indicator_values WHERE attribute_id = ?"
+        self.dbConn.executemany(query, [(attrib_ids[attribute],) for attribute in my_env.get_catalog_default_attribs()
+                                        if attribute in attrib_ids])
+        query = "DELETE FROM indicator_values WHERE attribute_id = ? AND value = " \
+                "(SELECT s.value || ? FROM indicator_values s " \
+                "WHERE s.indicator_id = indicator_values.indicator_id AND s.attribute_id = ?)"
+        self.dbConn.executemany(query, [(attrib_ids[attribute], suffix, attrib_ids[source])
+                                        for attribute, (source, suffix) in self.derived_attribs.items()
+                                        if attribute in attrib_ids and source in attrib_ids])
+        return
+
+    def _upgrade_v6(self):
+        """
+        Schema version 6: file manifest. Table file_manifest has the content hash (sha256), size and modification time
+        (epoch seconds) of the last published version of each file, so unchanged files are not published again.
+        :return:
+        """
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS file_manifest "
+                            "(filename text primary key, sha256 text, size integer, mtime integer, "
+                            "published_epoch integer)")
+        return
+
+    def _upgrade_v7(self):
+        """
+        Schema version 7: intake journal. Table intake_journal has the last step that was done for each file from
+        Dataroom, so a run that stopped can be resumed. Only files that are not completely handled are in the journal.
+        For a file that has been loaded, the content hash, size and modification time are kept until the file manifest
+        is updated.
+        :return:
+        """
+        self.dbConn.execute("CREATE TABLE IF NOT EXISTS intake_journal "
+                            "(filename text primary key, indicator_id integer, state text, "
+                            "sha256 text, size integer, mtime integer, updated_epoch integer)")
+        return
+
+    def _upgrade_v8(self):
+        """
+        Schema version 8: first publication time. Column first_seen (epoch seconds) is added to the indicator_changes
+        journal. It is set when the journal record of an indicator is created and never updated, so it is not moved
+        by later changes like created_epoch of the attribute records. Existing indicators get the oldest created_epoch
+        of their attribute records, which is the best value that is still available.
+        :return:
+        """
+        self.dbConn.execute("ALTER TABLE indicator_changes ADD COLUMN first_seen integer")
+        self.dbConn.execute("UPDATE indicator_changes SET first_seen = "
+                            "(SELECT min(created_epoch) FROM indicator_values v "
+                            "WHERE v.indicator_id = indicator_changes.indicator_id)")
+        for action in ['insert', 'update', 'delete']:
+            self.dbConn.execute("DROP TRIGGER IF EXISTS indicator_values_journal_{a}".format(a=action))
+        self._create_journal_triggers('indicator_values', first_seen=True)
+        return
+
+    def _start_write_behind(self):
+        """
+        Internal method to switch to write-behind mode. The database file is copied into a shared memory database with
+        the SQLite backup API. From then on all connections of the pool use the memory database.
+        Note that write-behind mode assumes that this object is the only writer of indicator records during the run.
+        Other processes see the changes only after a checkpoint. The connection is closed (with a last checkpoint) at
+        exit of the script, if the script did not close it.
+        :return:
+        """
+        logging.info("Start write-behind mode.")
+        self.checkpoint_interval = float(self.config['Main'].get('checkpoint_interval', '300'))
+        self.write_lock = threading.Lock()
+        # Changes at or after this moment are written to the database file on the next checkpoint.
+        self.last_checkpoint = int(epoch_now())
+        self._load_memory_copy()
+        self.write_behind = True
+        atexit.register(self.close_connection)
+        return
+
+    def _load_memory_copy(self):
+        """
+        Internal method to copy the database into a shared memory database with the SQLite backup API. From then on all
+        connections of the pool use the memory database.
+        :return:
+        """
+        logging.info("Copy database into memory.")
+        db_uri = "file:datastore_{i}?mode=memory&cache=shared".format(i=id(self))
+        mem_anchor = sqlite3.connect(db_uri, uri=True, isolation_level=None, check_same_thread=False)
+        self.dbConn.backup(mem_anchor)
+        # Close the connections to the database file, new connections are made to the memory database.
+        self.close_connection()
+        self.mem_anchor = mem_anchor
+        self.db_uri = db_uri
+        return
+
+    @timed
+    def checkpoint(self):
+        """
+        Method to write the changes in the memory database to the database file (write-behind mode only).
+        The database file is attached to a memory database connection. Indicators that changed since the previous
+        checkpoint (indicator_changes journal) are replaced in indicator_values. The small tables are copied as a whole,
+        so new, changed and removed records are written: attribute_action, sync_state (watermarks), file_manifest and
+        intake_journal. This is done in one transaction on the database file, so after a crash the database file has
+        the state of the previous checkpoint.
+        Do not call this method within a transaction() block.
+        :return:
+        """
+        if not self.write_behind:
+            return
+        since = self.last_checkpoint
+        self.last_checkpoint = int(epoch_now())
+        db_conn = self.dbConn
+        logging.info("Write-behind checkpoint, write changes since %s to database file.", since)
+        db_conn.execute("ATTACH DATABASE ? AS disk", (self.config['Main']['db'],))
+        try:
+            with self.transaction():
+                db_conn.execute("CREATE TEMP TABLE IF NOT EXISTS checkpoint_indics (indicator_id integer primary key)")
+                db_conn.execute("DELETE FROM temp.checkpoint_indics")
+                db_conn.execute("INSERT INTO temp.checkpoint_indics (indicator_id) "
+                                "SELECT indicator_id FROM main.indicator_changes WHERE changed >= ?", (since,))
+                for query in self._checkpoint_queries():
+                    db_conn.execute(query)
+                cnt = db_conn.execute("SELECT count(*) FROM temp.checkpoint_indics").fetchone()[0]
+        except:
+            # Changes will be written on the next checkpoint.
+            self.last_checkpoint = since
+            raise
+        finally:
+            db_conn.execute("DETACH DATABASE disk")
+        logging.info("Write-behind checkpoint done, %s indicators written.", cnt)
+        return
+
+    def _checkpoint_queries(self):
+        """
+        Internal method to get the queries that copy the changes from the memory database (main) to the database file
+        (disk). Temporary table checkpoint_indics has the indicators that changed since the previous checkpoint.
+        :return: List of queries.
+        """
+        queries = [
+            "DELETE FROM disk.attribute_action WHERE id NOT IN (SELECT id FROM main.attribute_action)",
+            "INSERT OR REPLACE INTO disk.attribute_action SELECT * FROM main.attribute_action",
+            "DELETE FROM disk.indicator_values WHERE indicator_id IN (SELECT indicator_id FROM temp.checkpoint_indics)",
+            "INSERT INTO disk.indicator_values (indicator_id, attribute_id, value, created_epoch) "
+            "SELECT indicator_id, attribute_id, value, created_epoch FROM main.indicator_values "
+            "WHERE indicator_id IN (SELECT indicator_id FROM temp.checkpoint_indics)",
+            "INSERT OR REPLACE INTO disk.sync_state SELECT * FROM main.sync_state",
+            "DELETE FROM disk.file_manifest WHERE filename NOT IN (SELECT filename FROM main.file_manifest)",
+            "INSERT OR REPLACE INTO disk.file_manifest SELECT * FROM main.file_manifest",
+            "DELETE FROM disk.intake_journal WHERE filename NOT IN (SELECT filename FROM main.intake_journal)",
+            "INSERT OR REPLACE INTO disk.intake_journal SELECT * FROM main.intake_journal",
+        ]
+        return queries
+
+    @timed
+    def backup(self, filename, compress=False):
+        """
+        Method to copy the database to a file while the pipeline keeps working on it (online backup). The SQLite
+        backup API copies backup_pages pages per step (section Main, default 256) and sleeps backup_sleep seconds
+        between steps (default 0.05), so writers are blocked for one step only. If the database is changed by another
+        connection during the backup, the backup API restarts the copy. The backup has the state of the database at
+        the end of the copy.
+        In write-behind mode the memory database is copied, so the backup includes changes that are not yet written to
+        the database file.
+        The backup is written to a temporary file first, an existing backup file is replaced only when the copy is
+        complete.
+        :param filename: Name of the backup file.
+        :param compress: True to compress the backup with gzip. Extension .gz is added to the filename if required.
+        :return: Name of the backup file.
+        """
+        pages = int(self.config['Main'].get('backup_pages', '256'))
+        sleep = float(self.config['Main'].get('backup_sleep', '0.05'))
+        if compress and not filename.endswith('.gz'):
+            filename += '.gz'
+        tmp_file = filename + '.tmp'
+        db_file = tmp_file[:-len('.gz.tmp')] + '.db.tmp' if compress else tmp_file
+
+        def progress(status, remaining, total):
+            logging.debug("Backup: %s of %s pages copied.", total - remaining, total)
+
+        logging.info("Backup database to %s", filename)
+        # Separate connection, so the backup doesn't interfere with a transaction of the current thread.
+        src_conn, src_cur = self._connect2db()
+        dst_conn = sqlite3.connect(db_file)
+        try:
+            src_conn.backup(dst_conn, pages=pages, progress=progress, sleep=sleep)
+            # A backup of a wal database is in wal mode. Rollback journal mode allows to open the backup read-only.
+            dst_conn.execute("PRAGMA journal_mode = DELETE")
+        finally:
+            dst_conn.close()
+            src_conn.close()
+        if compress:
+            with open(db_file, 'rb') as f_in, gzip.open(tmp_file, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.remove(db_file)
+        os.replace(tmp_file, filename)
+        logging.info("Backup done, %s bytes written.", os.path.getsize(filename))
+        return filename
+
+    @staticmethod
+    def open_snapshot(config, filename):
+        """
+        Method to open a backup (see method backup) for reporting. The backup is opened as a read-only Datastore, so
+        catalog default and derived attributes are resolved as in the live datastore.
+        A gzip compressed backup is loaded into a memory database. Otherwise the backup file is opened read-only.
+        :param config: config object, for the options of the Datastore.
+        :param filename: Name of the backup file.
+        :return: Read-only Datastore object on the snapshot. Call close_connection when done.
+        """
+        snapshot_config = configparser.ConfigParser(interpolation=None)
+        snapshot_config.read_dict({section: dict(config.items(section, raw=True)) for section in config.sections()})
+        if not filename.endswith('.gz'):
+            snapshot_config['Main']['db'] = filename
+            snapshot_config['Main']['read_only_copy'] = 'off'
+            return Datastore(snapshot_config, read_only=True)
+        tmp_file = filename[:-len('.gz')] + '.snapshot.tmp'
+        with gzip.open(filename, 'rb') as f_in, open(tmp_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        snapshot_config['Main']['db'] = tmp_file
+        snapshot_config['Main']['read_only_copy'] = 'on'
+        try:
+            return Datastore(snapshot_config, read_only=True)
+        finally:
+            os.remove(tmp_file)
+
     def close_connection(self):
         """
-        Method to close the Database Connection.
+        Method to close the Database Connection. All connections in the pool are closed.
         :return:
         """
         logging.debug("Close connection to database")
+        if self.cache_size > 0:
+            logging.info("Indicator cache statistics: %s", self.get_cache_stats())
+        if self.write_behind:
+            self.checkpoint()
+            atexit.unregister(self.close_connection)
+        if self.timing is not None:
+            self.log_query_stats()
+        with self.pool_lock:
+            connections = self.conn_idle + [conn for thread, conn in self.conn_in_use]
+            self.conn_idle = []
+            self.conn_in_use = []
+        self.local.conn = None
+        if self.mem_anchor is not None:
+            # Closing the last connection to the memory database removes it.
+            connections.append(self.mem_anchor)
+            self.mem_anchor = None
+            self.db_uri = None
+            self.write_behind = False
+        for db_conn in connections:
+            try:
+                db_conn.close()
+            except:
+                e = sys.exc_info()[1]
+                ec = sys.exc_info()[0]
+                log_msg = "Error during close connect to database: %s %s"
+                logging.error(log_msg, e, ec)
+        return
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager for a unit of work on the datastore. All writes within the block are done in a single
+        transaction, so one commit (and one fsync) is done for the block instead of one commit per write.
+        Blocks can be nested, only the outermost block commits. On an exception the transaction is rolled back.
+        Reads within the block use the same connection, so they see the uncommitted writes of the block.
+        The outermost block starts with BEGIN IMMEDIATE, so the write lock is taken (with busy timeout and retry) at the
+        start of the block and not halfway.
+        :return:
+        """
+        db_conn = self.dbConn
+        if self.local.trans_depth == 0:
+            # In write-behind mode the threads of this process are the only writers, they take turns.
+            if self.write_behind:
+                self.write_lock.acquire()
+            try:
+                self._retry_busy(db_conn.execute, "BEGIN" if self.read_only else "BEGIN IMMEDIATE")
+            except:
+                if self.write_behind:
+                    self.write_lock.release()
+                raise
+        self.local.trans_depth += 1
         try:
-            self.dbConn.close()
+            yield self
         except:
-            e = sys.exc_info()[1]
-            ec = sys.exc_info()[0]
-            log_msg = "Error during close connect to database: %s %s"
-            logging.error(log_msg, e, ec)
-            return
+            self.local.trans_depth -= 1
+            if self.local.trans_depth == 0:
+                logging.error("Exception during transaction, rolling back.")
+                db_conn.rollback()
+                # The caches may have uncommitted values: indicator values, and attribute IDs of attributes that were
+                # added in the transaction.
+                with self.cache_lock:
+                    self.indic_cache.clear()
+                self._reset_attrib_map()
+                if self.write_behind:
+                    self.write_lock.release()
+            raise
         else:
-            return
+            self.local.trans_depth -= 1
+            if self.local.trans_depth == 0:
+                try:
+                    self._retry_busy(db_conn.commit)
+                finally:
+                    if self.write_behind:
+                        self.write_lock.release()
+                if self.write_behind and epoch_now() - self.last_checkpoint > self.checkpoint_interval:
+                    self.checkpoint()
+        return
 
+    def _write(self, query, rows):
+        """
+        Internal method to execute a write query for a list of parameter rows with executemany. The write is committed
+        immediately, unless it is done within a transaction() block.
+        :param query: Insert, update or delete query.
+        :param rows: List of parameter tuples for the query.
+        :return:
+        """
+        with self.transaction():
+            self.dbConn.executemany(query, rows)
+        return
+
+    @timed
     def insert_indicator(self, indicator_id, attribute, value):
         """
         This method will insert a record in the indicators table. Date / Time of insert is calculated.
+        Check method upsert_indicator_attributes to write more than one attribute for the indicator.
         :param indicator_id: ID of the indicator.
         :param attribute:  Attribute, this should be in attribute_action table (but not yet verified).
         :param value: related to the attribute.
@@ -80,14 +813,68 @@ class Datastore:
         """
         logging.debug("Remove then adding to indicator table ID: %s, Attribute: %s, Value: %s",
                       indicator_id, attribute, value)
-        self.remove_indicator_attribute(indicator_id, attribute)
-        now = strftime("%H:%M:%S %d-%m-%Y")
-        query = "INSERT INTO indicators (indicator_id, attribute, value, created)" \
-                "VALUES (?, ?, ?, ?)"
-        self.dbConn.execute(query, (indicator_id, attribute, value, now))
-        self.dbConn.commit()
+        self.upsert_indicator_attributes(indicator_id, {attribute: value})
         return
 
+    @timed
+    def upsert_indicator_attributes(self, indicator_id, attribs):
+        """
+        This method will set all attribute / value pairs for the indicator. Existing values for the attributes are
+        replaced. All writes are done in a single transaction.
+        :param indicator_id: ID of the indicator.
+        :param attribs: Dictionary with attribute name as key and attribute value as value.
+        :return:
+        """
+        self.upsert_indicators({indicator_id: attribs})
+        return
+
+    @timed
+    def upsert_indicators(self, indicators):
+        """
+        This method will set attribute / value pairs for one or more indicators. Existing values for the attributes
+        are replaced. All writes are done in a single transaction, with one executemany INSERT ... ON CONFLICT DO
+        UPDATE statement on the unique (indicator_id, attribute_id) index (requires SQLite 3.24 or later).
+        Values are stored with their natural type (string, integer, ...).
+        The created timestamp is set for new records and for records where the value changes, so created_epoch is the
+        time of the last change of the value.
+        :param indicators: Dictionary with indicator ID as key and dictionary of attribute / value pairs as value.
+        :return:
+        """
+        now_epoch = int(epoch_now())
+        if not any(indicators.values()):
+            return
+        with self.transaction():
+            attrib_ids = self._get_attribute_ids(
+                set(attribute for attribs in indicators.values() for attribute in attribs))
+            rows = [(indicator_id, attrib_ids[attribute], value, now_epoch)
+                    for indicator_id, attribs in indicators.items() for attribute, value in attribs.items()]
+            logging.debug("Upsert %s attribute(s) for %s indicator(s)", len(rows), len(indicators))
+            self._write(self.statements['upsert_value'], rows)
+        with self.cache_lock:
+            for indicator_id, attribs in indicators.items():
+                if indicator_id in self.indic_cache:
+                    self.indic_cache[indicator_id].update(attribs)
+        return
+
+    def _get_attribute_ids(self, attribs):
+        """
+        Internal method to translate attribute names to attribute_action IDs. An attribute that is not in the
+        attribute_action table is added without source, target and action (db_consistency will report it).
+        :param attribs: Collection of attribute names.
+        :return: Dictionary with attribute name as key and attribute_action ID as value.
+        """
+        attrib_ids = self._get_attrib_map()['ids']
+        unknown = [attribute for attribute in attribs if attribute not in attrib_ids]
+        if unknown:
+            logging.warning("Attributes %s not in attribute_action table, adding them.", unknown)
+            now = strftime("%H:%M:%S %d-%m-%Y")
+            query = "INSERT INTO attribute_action (attribute, created, created_epoch) VALUES (?, ?, ?)"
+            self._write(query, [(attribute, now, int(epoch_now())) for attribute in unknown])
+            self._reset_attrib_map()
+            attrib_ids = self._get_attrib_map()['ids']
+        return {attribute: attrib_ids[attribute] for attribute in attribs}
+
+    @timed
     def remove_indicator_attribute(self, indicator_id, attribute):
         """
         This method will remove the record for the indicator / attribute combination.
@@ -97,11 +884,44 @@ class Datastore:
         """
         # TODO - Count number of records deleted.
         logging.debug("Removing from indicator table ID: %s, Attribute: %s", indicator_id, attribute)
-        query = "DELETE FROM indicators WHERE indicator_id = ? AND attribute = ?"
-        self.dbConn.execute(query, (indicator_id, attribute))
-        self.dbConn.commit()
+        self.remove_indicator_attributes(indicator_id, [attribute])
+        return
+
+    @timed
+    def remove_indicator_attributes(self, indicator_id, attribs):
+        """
+        This method will remove the records for a list of attributes of the indicator in a single transaction.
+        :param indicator_id: ID of the indicator.
+        :param attribs: List of attribute names to remove.
+        :return:
+        """
+        attrib_ids = self._get_attrib_map()['ids']
+        keys = [(indicator_id, attrib_ids[attribute]) for attribute in attribs if attribute in attrib_ids]
+        if keys:
+            self._write(self.statements['remove_value'], keys)
+            with self.cache_lock:
+                if indicator_id in self.indic_cache:
+                    for attribute in attribs:
+                        self.indic_cache[indicator_id].pop(attribute, None)
+        return
+
+    @timed
+    def replace_indicator_attributes(self, indicator_id, attribs, scope):
+        """
+        This method will replace a set of attributes of the indicator in a single transaction. Attributes in scope that
+        are not in attribs are removed, the attributes in attribs are set. Values that did not change are not rewritten.
+        :param indicator_id: ID of the indicator.
+        :param attribs: Dictionary with attribute name as key and attribute value as value.
+        :param scope: Collection of attribute names that are replaced, e.g. all attributes with source Dataroom.
+        :return:
+        """
+        with self.transaction():
+            self.remove_indicator_attributes(indicator_id, [attribute for attribute in scope
+                                                            if attribute not in attribs])
+            self.upsert_indicator_attributes(indicator_id, attribs)
         return
 
+    @timed
     def get_indicator_value(self, indicator_id, attribute):
         """
         This method will get the value for attribute name and indicator ID. Check with method 'get_indicator_val',
@@ -111,10 +931,18 @@ class Datastore:
         :return: Array of result lists. Each result list has one element, the required value. Empty list is returned if
         no values are found.
         """
+        if self.cache_size > 0 or attribute in self.catalog_defaults or attribute in self.derived_attribs:
+            if self.cache_size > 0:
+                indic_attribs = self._get_cached_indicators([indicator_id])[indicator_id]
+            else:
+                indic_attribs = self._query_snapshot([indicator_id]).get(indicator_id, {})
+            value = self._resolve_attribute(indic_attribs, attribute)
+            if value is not None:
+                return [(value,)]
+            return []
         logging.debug("SELECT value FROM indicators WHERE indicator_id = %s and attribute = %s",
                       indicator_id, attribute)
-        query = "SELECT value FROM indicators WHERE indicator_id = ? and attribute = ?"
-        self.cur.execute(query, (indicator_id, attribute))
+        self.cur.execute(self.statements['indicator_value'], (indicator_id, attribute))
         values_lst = self.cur.fetchall()
         return values_lst
 
@@ -133,6 +961,7 @@ class Datastore:
             res_str = 'niet gevonden'
         return res_str
 
+    @timed
     def get_indicator_attrib_values(self, indicator_id, attribs):
         """
         This method gets an indicator ID and a list of attribute names. It will collect all values for available in
@@ -142,12 +971,379 @@ class Datastore:
         :return: Array of (attribute, value) lists.
         """
         logging.debug("Get attribute/value pairs for indicator %s", indicator_id)
-        query = "SELECT attribute, value FROM indicators WHERE indicator_id = ? AND attribute IN " + str(tuple(attribs))
+        if self.cache_size > 0 or self._has_resolved_attribute(attribs):
+            indic_attribs = self.get_indicator_snapshot(indicator_id).get(indicator_id, {})
+            return [(attribute, indic_attribs[attribute]) for attribute in attribs if attribute in indic_attribs]
+        if not attribs:
+            return []
+        in_list, params = self._in_list(list(attribs))
+        query = self.statements['indicator_attrib_values'].format(in_list=in_list)
         logging.debug("Query: %s", query)
-        self.cur.execute(query, (indicator_id,))
+        self.cur.execute(query, [indicator_id] + params)
         res = self.cur.fetchall()
         return res
 
+    @timed
+    def get_indicator_snapshot(self, indicator_ids=None):
+        """
+        This method will get all attributes for one or more indicators with a single query (one query per 512
+        indicators), as an alternative for a get_indicator_value call per attribute.
+        :param indicator_ids: Indicator ID, list of indicator IDs or None for all indicators.
+        :return: Dictionary with indicator ID as key and dictionary of attribute / value pairs as value. An indicator
+        without attributes in the indicators table is not in the dictionary.
+        """
+        if indicator_ids is not None and not isinstance(indicator_ids, list):
+            indicator_ids = [indicator_ids]
+        if self.cache_size > 0 and indicator_ids is not None:
+            stored = self._get_cached_indicators(indicator_ids)
+        else:
+            stored = self._query_snapshot(indicator_ids)
+        return {indicator_id: self._resolve_attributes(attribs) for indicator_id, attribs in stored.items() if attribs}
+
+    def _has_resolved_attribute(self, attribs):
+        """
+        Internal method to check if a list of attributes has catalog default or derived attributes.
+        :param attribs: List of attribute names.
+        :return: True if at least one attribute is resolved at read time, False otherwise.
+        """
+        for attribute in attribs:
+            if attribute in self.catalog_defaults or attribute in self.derived_attribs:
+                return True
+        return False
+
+    def _resolve_attribute(self, stored, attribute):
+        """
+        Internal method to get the value of an attribute for an indicator. A stored value has priority. Otherwise a
+        derived attribute is calculated from its source attribute, or the catalog default is used. Catalog defaults
+        apply only to indicators that have attributes in the indicators table.
+        :param stored: Dictionary with the attribute / value pairs in the indicators table for the indicator.
+        :param attribute: Attribute name.
+        :return: Value of the attribute, None if the attribute is not available for the indicator.
+        """
+        if attribute in stored:
+            return stored[attribute]
+        if attribute in self.derived_attribs:
+            source, suffix = self.derived_attribs[attribute]
+            if source in stored:
+                return stored[source] + suffix
+        if stored and attribute in self.catalog_defaults:
+            return self.catalog_defaults[attribute]
+        return None
+
+    def _resolve_attributes(self, stored):
+        """
+        Internal method to add catalog default and derived attributes to the stored attributes of an indicator.
+        :param stored: Dictionary with the attribute / value pairs in the indicators table for the indicator.
+        :return: New dictionary with all attribute / value pairs for the indicator.
+        """
+        attribs = dict(stored)
+        for attribute in list(self.derived_attribs) + list(self.catalog_defaults):
+            if attribute not in attribs:
+                value = self._resolve_attribute(stored, attribute)
+                if value is not None:
+                    attribs[attribute] = value
+        return attribs
+
+    def _query_snapshot(self, indicator_ids):
+        """
+        Internal method to read all attributes for a list of indicators from the database.
+        :param indicator_ids: List of indicator IDs or None for all indicators.
+        :return: Dictionary with indicator ID as key and dictionary of attribute / value pairs as value.
+        """
+        names = self._get_attrib_map()['names']
+        if indicator_ids is None:
+            queries = [(self.statements['snapshot'], [])]
+        else:
+            queries = []
+            for pos in range(0, len(indicator_ids), self.max_in_list):
+                in_list, params = self._in_list(indicator_ids[pos:pos+self.max_in_list])
+                queries.append((self.statements['snapshot_ids'].format(in_list=in_list), params))
+        snapshot = {}
+        for query, params in queries:
+            logging.debug("Query: %s", query)
+            for indicator_id, attribute_id, value in self.dbConn.execute(query, params):
+                if attribute_id in names:
+                    snapshot.setdefault(indicator_id, {})[names[attribute_id]] = value
+        return snapshot
+
+    def _get_cached_indicators(self, indicator_ids):
+        """
+        Internal method to get the attributes for a list of indicators through the LRU cache. Indicators that are not
+        in the cache are read from the database with one query and added to the cache. Least recently used indicators
+        are evicted when the cache holds more than cache_size indicators.
+        Note that the dictionaries in the cache are returned, the caller should not modify them.
+        :param indicator_ids: List of indicator IDs.
+        :return: Dictionary with indicator ID as key and dictionary of attribute / value pairs as value. Indicators
+        without attributes have an empty dictionary.
+        """
+        self._check_data_version()
+        res = {}
+        missing = []
+        with self.cache_lock:
+            for indicator_id in indicator_ids:
+                if indicator_id in self.indic_cache:
+                    self.cache_stats['hits'] += 1
+                    self.indic_cache.move_to_end(indicator_id)
+                    res[indicator_id] = self.indic_cache[indicator_id]
+                else:
+                    self.cache_stats['misses'] += 1
+                    missing.append(indicator_id)
+        if missing:
+            snapshot = self._query_snapshot(missing)
+            with self.cache_lock:
+                for indicator_id in missing:
+                    res[indicator_id] = snapshot.get(indicator_id, {})
+                    self.indic_cache[indicator_id] = res[indicator_id]
+                while len(self.indic_cache) > self.cache_size:
+                    self.indic_cache.popitem(last=False)
+                    self.cache_stats['evictions'] += 1
+        return res
+
+    def _get_trace(self):
+        """
+        Internal method to get the list of SQL statements that the connection of the current thread has executed in
+        the running timed method.
+        :return: List of SQL statements.
+        """
+        if getattr(self.local, 'trace', None) is None:
+            self.local.trace = []
+        return self.local.trace
+
+    def _trace_statement(self, statement):
+        """
+        Internal method, trace callback of the connections when query timing is on. The statements are collected for
+        the slow query log. Transaction statements, PRAGMA statements and trigger statements are skipped.
+        :param statement: SQL statement, with the parameter values.
+        :return:
+        """
+        if statement.startswith('--') or \
+                statement.split(None, 1)[0].upper() in ['BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA']:
+            return
+        trace = self._get_trace()
+        # executemany traces each row, keep a limited number of statements.
+        if len(trace) < 5 and statement not in trace:
+            trace.append(statement)
+        return
+
+    def _log_slow_query(self, name, duration, statements):
+        """
+        Internal method to log a slow Datastore call with the query plan of the SQL statements that it executed.
+        :param name: Name of the Datastore method.
+        :param duration: Execution time in seconds.
+        :param statements: SQL statements executed by the method.
+        :return:
+        """
+        logging.warning("Slow query: %s took %.1f ms", name, duration * 1000)
+        trace = self.local.trace
+        # The EXPLAIN statements must not be traced.
+        self.local.trace = []
+        try:
+            for statement in statements:
+                plan = self.dbConn.execute("EXPLAIN QUERY PLAN " + statement).fetchall()
+                logging.warning("Statement: %s - Plan: %s", statement[:500], " | ".join(row[-1] for row in plan))
+        except sqlite3.Error:
+            e = sys.exc_info()[1]
+            ec = sys.exc_info()[0]
+            log_msg = "Error during explain of slow query: %s %s"
+            logging.error(log_msg, e, ec)
+        finally:
+            self.local.trace = trace
+        return
+
+    def get_query_stats(self):
+        """
+        This method returns the execution time statistics per Datastore method (query timing must be on).
+        :return: Dictionary with method name as key and dictionary with count, total, p50, p95 and p99 (seconds) as
+        value.
+        """
+        if self.timing is None:
+            return {}
+        return self.timing.summary()
+
+    def log_query_stats(self):
+        """
+        This method logs the execution time statistics per Datastore method, slowest total time first.
+        :return:
+        """
+        stats = self.get_query_stats()
+        for name in sorted(stats, key=lambda n: stats[n]['total'], reverse=True):
+            st = stats[name]
+            logging.info("Query timing %s: count %s, total %.1f ms, p50 %.2f ms, p95 %.2f ms, p99 %.2f ms",
+                         name, st['count'], st['total'] * 1000, st['p50'] * 1000, st['p95'] * 1000, st['p99'] * 1000)
+        return
+
+    def get_cache_stats(self):
+        """
+        This method returns the statistics of the indicator cache.
+        :return: Dictionary with hits, misses, evictions and size (number of indicators in cache).
+        """
+        stats = dict(self.cache_stats)
+        stats['size'] = len(self.indic_cache)
+        return stats
+
+    @timed
+    def get_indicator_timestamps(self, indicator_ids=None):
+        """
+        This method will get the time of the first publication and the last change for one or more indicators. The
+        first publication is the first_seen time in the indicator_changes journal, which is never updated. The last
+        change is the newest created_epoch timestamp of the attribute records.
+        :param indicator_ids: Indicator ID, list of indicator IDs or None for all indicators.
+        :return: Dictionary with indicator ID as key and (first, last) epoch seconds as value.
+        """
+        if indicator_ids is None:
+            queries = [(self.statements['timestamps'], [])]
+        else:
+            indicator_ids = indicator_ids if isinstance(indicator_ids, list) else [indicator_ids]
+            queries = []
+            for pos in range(0, len(indicator_ids), self.max_in_list):
+                in_list, params = self._in_list(indicator_ids[pos:pos+self.max_in_list])
+                queries.append((self.statements['timestamps_ids'].format(in_list=in_list), params))
+        timestamps = {}
+        for query, params in queries:
+            logging.debug("Query: %s", query)
+            for indicator_id, first, last in self.dbConn.execute(query, params):
+                timestamps[indicator_id] = (first, last)
+        return timestamps
+
+    def _in_list(self, values):
+        """
+        Internal method to get the placeholders for an IN list. The number of placeholders is rounded up to a power of
+        2 and the list of values is padded with its last value, so queries with IN lists of different length share a
+        limited number of statement texts (and compiled statements in the statement cache).
+        :param values: List of values for the IN list, at least one and at most max_in_list values.
+        :return: Placeholder string and list of parameter values.
+        """
+        size = 1
+        while size < len(values):
+            size *= 2
+        params = list(values) + [values[-1]] * (size - len(values))
+        return ", ".join("?" * size), params
+
+    @timed
+    def get_dirty_indicators(self, since=None):
+        """
+        This method will get the indicators that have changed since a point in time. Changes are recorded in the
+        indicator_changes journal for every write on the indicators table.
+        :param since: Epoch seconds, typically a watermark from get_sync_watermark. None for all indicators in the
+        journal.
+        :return: List of indicator IDs that have changed at or after since.
+        """
+        query = self.statements['dirty_indicators']
+        logging.debug("Query: %s (since: %s)", query, since)
+        res = self.dbConn.execute(query, (since or 0,)).fetchall()
+        return [row[0] for row in res]
+
+    @timed
+    def get_sync_watermark(self, target):
+        """
+        This method returns the watermark of the last successful synchronization to a target.
+        :param target: Name of the synchronization target, e.g. 'ckan'.
+        :return: Epoch seconds of the start of the last successful synchronization, None if not yet synchronized.
+        """
+        res = self.dbConn.execute(self.statements['get_watermark'], (target,)).fetchone()
+        if res:
+            return res[0]
+        return None
+
+    @timed
+    def set_sync_watermark(self, target, watermark):
+        """
+        This method will set the watermark for a synchronization target. Call this method after a successful
+        synchronization, with the time the synchronization started.
+        :param target: Name of the synchronization target, e.g. 'ckan'.
+        :param watermark: Epoch seconds.
+        :return:
+        """
+        logging.debug("Set sync watermark for %s to %s", target, watermark)
+        self._write(self.statements['set_watermark'], [(target, watermark)])
+        return
+
+    @timed
+    def get_manifest(self, filename):
+        """
+        This method returns the manifest record of the last published version of a file.
+        :param filename: Name of the file (without path).
+        :return: (sha256, size, mtime) tuple, None if the file is not in the manifest.
+        """
+        return self.dbConn.execute(self.statements['get_manifest'], (filename,)).fetchone()
+
+    @timed
+    def set_manifest(self, filename, sha256, size, mtime):
+        """
+        This method will register the published version of a file in the manifest.
+        :param filename: Name of the file (without path).
+        :param sha256: Content hash of the file (hex digest).
+        :param size: Size of the file in bytes.
+        :param mtime: Modification time of the file (epoch seconds).
+        :return:
+        """
+        logging.debug("Set manifest for %s: %s, %s bytes", filename, sha256, size)
+        self._write(self.statements['set_manifest'], [(filename, sha256, size, int(mtime), int(epoch_now()))])
+        return
+
+    @timed
+    def remove_manifest(self, filename):
+        """
+        This method will remove a file from the manifest, so the next version of the file is published.
+        :param filename: Name of the file (without path).
+        :return:
+        """
+        logging.debug("Remove manifest for %s", filename)
+        self._write(self.statements['remove_manifest'], [(filename,)])
+        return
+
+    @timed
+    def set_intake_state(self, filename, indicator_id, state, complete=False, manifest=None):
+        """
+        This method registers the last step that was done for a file in the intake journal. The journal has only the
+        files that are not completely handled: a file is removed from the journal after its last step.
+        :param filename: Name of the file (without path).
+        :param indicator_id: ID of the indicator.
+        :param state: Last step, e.g. moved, uploaded, db-updated or ckan-synced.
+        :param complete: True if this is the last step for the file.
+        :param manifest: (sha256, size, mtime) of the file if it has been loaded.
+        :return:
+        """
+        logging.debug("Intake journal %s: %s", filename, state)
+        if complete:
+            self._write(self.statements['remove_intake'], [(filename, )])
+            return
+        sha256, size, mtime = manifest or (None, None, None)
+        if mtime is not None:
+            mtime = int(mtime)
+        row = (filename, indicator_id, state, sha256, size, mtime, int(epoch_now()))
+        self._write(self.statements['set_intake_state'], [row])
+        if self.write_behind:
+            # A new file is registered in the database file immediately, so it is resumed after a crash also if the
+            # crash is before the next checkpoint. Later steps are written at the checkpoint with the database
+            # changes of the step: after a crash the file is resumed from the last step in the database file.
+            self._write_through(self.statements['register_intake'], [row])
+        return
+
+    def _write_through(self, query, rows):
+        """
+        Internal method to execute a write query on the database file in write-behind mode, bypassing the memory
+        database.
+        :param query: Insert, update or delete query.
+        :param rows: List of parameter tuples for the query.
+        :return:
+        """
+        db_conn = sqlite3.connect(self.config['Main']['db'], timeout=self.busy_timeout, isolation_level=None)
+        try:
+            self._retry_busy(db_conn.executemany, query, rows)
+        finally:
+            db_conn.close()
+        return
+
+    @timed
+    def get_open_intake(self):
+        """
+        This method returns the files in the intake journal that are not completely handled.
+        :return: List of (filename, indicator_id, state, sha256, size, mtime) tuples.
+        """
+        return self.dbConn.execute(self.statements['open_intake']).fetchall()
+
+    @timed
     def get_indicator_ids(self):
         """
         This method will get all indicator IDs for indicators that are published for public on the Open Data Set. This
@@ -161,6 +1357,7 @@ class Datastore:
         indic_array = [indic_id[0] for indic_id in res]
         return indic_array
 
+    @timed
     def get_indicator_cognos_urls(self):
         """
         This method will get all indicator IDs for indicators that have a Cognos URL available (url_cognos exist).
@@ -173,6 +1370,7 @@ class Datastore:
         indic_array = [indic_id[0] for indic_id in res]
         return indic_array
 
+    @timed
     def check_resource(self, indic_id, res_type):
         """
         This procedure will check if the resource URL is available. If URL is available then resource can be
@@ -198,6 +1396,7 @@ class Datastore:
             logging.error(log_msg, res_type, indic_id)
             return False
 
+    @timed
     def check_resource_published(self, indic_id, res_type):
         """
         This procedure will check if the resource is published on Open Dataset. A resource is published on Open Dataset
@@ -220,36 +1419,87 @@ class Datastore:
             logging.error(log_msg, res_type, indic_id)
             return False
 
+    def _check_data_version(self):
+        """
+        Internal method to verify that the caches are still valid. PRAGMA data_version changes when another
+        connection (another process or another thread) has committed changes to the database. In that case all cached
+        information is dropped.
+        :return:
+        """
+        data_version = self.dbConn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self.local.data_version:
+            if self.local.data_version is not None:
+                logging.debug("Database changed by another connection, reset caches.")
+                with self.cache_lock:
+                    self.attrib_map = None
+                    self.indic_cache.clear()
+            self.local.data_version = data_version
+        return
+
+    def _get_attrib_map(self):
+        """
+        Internal method to get the attribute_action lookup structures. The attribute_action table is loaded once and
+        kept in memory. The cache is reloaded after a write on the attribute_action table through this object, or
+        when PRAGMA data_version shows that another connection has changed the database.
+        :return: Dictionary (read-only) with keys 'attribs': tuple of all attribute names, 'ids': attribute name to
+        ID, 'names': ID to attribute name, 'by_source': source to tuple of attribute names, 'by_action': (source,
+        target, action) to tuple of (attribute, od_field) pairs.
+        """
+        self._check_data_version()
+        if self.attrib_map is None:
+            logging.debug("Loading attribute_action table in cache.")
+            query = "SELECT id, attribute, od_field, source, target, action FROM attribute_action ORDER BY id"
+            attribs = []
+            ids = {}
+            by_source = {}
+            by_action = {}
+            for attrib_id, attribute, od_field, source, target, action in self.dbConn.execute(query):
+                attribs.append(attribute)
+                ids[attribute] = attrib_id
+                by_source.setdefault(source, []).append(attribute)
+                by_action.setdefault((source, target, action), []).append((attribute, od_field))
+            self.attrib_map = MappingProxyType({
+                'attribs': tuple(attribs),
+                'ids': MappingProxyType(ids),
+                'names': MappingProxyType({v: k for k, v in ids.items()}),
+                'by_source': MappingProxyType({k: tuple(v) for k, v in by_source.items()}),
+                'by_action': MappingProxyType({k: tuple(v) for k, v in by_action.items()}),
+            })
+        return self.attrib_map
+
+    def _reset_attrib_map(self):
+        """
+        Internal method to invalidate the attribute_action cache after a write on the attribute_action table.
+        :return:
+        """
+        self.attrib_map = None
+        return
+
     def get_attribs_source(self, source):
         """
         Tbis method collects all attributes for a specific source.
         :param source: Value of the source parameter
         :return: Array of result lists. Each result list has one element: the attribute name.
         """
-        logging.debug("SELECT attribute FROM attribute_action WHERE source = '%s'",
-                      source)
-        query = "SELECT attribute FROM attribute_action WHERE source = ?"
-        self.cur.execute(query, (source, ))
-        attribs = self.cur.fetchall()
-        return attribs
+        logging.debug("Get attributes for source %s", source)
+        attribs = self._get_attrib_map()['by_source'].get(source, ())
+        return [(attribute,) for attribute in attribs]
 
     def get_attrib_od_pairs(self, source, target, action):
         """
         This method returns the pairs (attribute_name, Open Data name) for all attributes from a specific action.
-        Input parameters can be string or arrays. The query will check for all values in the array.
+        Input parameters can be string or arrays. The method will check for all values in the array.
         :param source: Source for the attribute / Open data pairs
         :param target: Target for the attribute / Open data pairs
         :param action: The action field.
         :return: Array of (unique attribute name, Open Data name) lists.
         """
-        source = my_env.get_array(source)
-        target = my_env.get_array(target)
-        action = my_env.get_array(action)
-        query = "SELECT attribute, od_field FROM attribute_action " \
-                "WHERE source IN " + source + " AND target IN " + target + " AND action IN " + action
-        logging.debug("Query: %s", query)
-        self.cur.execute(query)
-        res = self.cur.fetchall()
+        by_action = self._get_attrib_map()['by_action']
+        res = []
+        for src in ([source] if isinstance(source, str) else source):
+            for trg in ([target] if isinstance(target, str) else target):
+                for act in ([action] if isinstance(action, str) else action):
+                    res.extend(by_action.get((src, trg, act), ()))
         return res
 
     def get_all_attribs(self):
@@ -257,16 +1507,14 @@ class Datastore:
         Tbis method collects all attributes.
         :return: Array of attributes.
         """
-        query = "SELECT attribute FROM attribute_action"
-        logging.debug(query)
-        self.cur.execute(query)
-        attribs = self.cur.fetchall()
-        attrib_array = [attrib[0] for attrib in attribs]
-        return attrib_array
+        return list(self._get_attrib_map()['attribs'])
 
+    @timed
     def insert_attribute(self, attribute, od_field, source, target, action):
         """
         This method will insert a record in the attribute_action table. Date / Time of insert is calculated.
+        If the attribute exists already, then the record is updated. The attribute ID remains the same, since it is
+        used in table indicator_values.
         :param attribute:
         :param od_field:
         :param source:
@@ -274,16 +1522,18 @@ class Datastore:
         :param action:
         :return:
         """
-        logging.debug("Remove attribute, then add to attribute_action table attribute: %s, od_field: %s", attribute,
-                      od_field)
-        self.remove_attribute(attribute)
+        logging.debug("Add to attribute_action table attribute: %s, od_field: %s", attribute, od_field)
         now = strftime("%H:%M:%S %d-%m-%Y")
-        query = "INSERT INTO attribute_action (attribute, od_field, source, target, action, created)" \
-                "VALUES (?, ?, ?, ?, ?, ?)"
-        self.dbConn.execute(query, (attribute, od_field, source, target, action, now))
-        self.dbConn.commit()
+        query = "INSERT INTO attribute_action (attribute, od_field, source, target, action, created, created_epoch) " \
+                "VALUES (?, ?, ?, ?, ?, ?, ?) " \
+                "ON CONFLICT (attribute) DO UPDATE SET od_field = excluded.od_field, source = excluded.source, " \
+                "target = excluded.target, action = excluded.action, created = excluded.created, " \
+                "created_epoch = excluded.created_epoch"
+        self._write(query, [(attribute, od_field, source, target, action, now, int(epoch_now()))])
+        self._reset_attrib_map()
         return
 
+    @timed
     def update_attribute(self, attribute, od_field):
         """
         This method will update the attribute in attribute_action with the od_field specified.
@@ -293,56 +1543,53 @@ class Datastore:
         """
         logging.debug("Update attribute_action table - Attribute: %s, OD Field: %s", attribute, od_field)
         query = "UPDATE attribute_action SET od_field = ? WHERE attribute = ?"
-        self.dbConn.execute(query, (od_field, attribute))
-        self.dbConn.commit()
+        self._write(query, [(od_field, attribute)])
+        self._reset_attrib_map()
         return
 
+    @timed
     def remove_attribute(self, attribute):
         """
-        This method will remove the attribute from attribute_action.
+        This method will remove the attribute from attribute_action. If indicator_values has values for the attribute,
+        then the attribute is only unregistered (no od_field, source, target and action): the values keep their
+        attribute ID, so they are available again when the attribute is inserted again (insert_attribute).
         :param attribute:
         :return:
         """
         logging.debug("Delete attribute %s from attribute_action table.", attribute)
-        query = "DELETE FROM attribute_action WHERE attribute = ?"
-        self.dbConn.execute(query, (attribute, ))
-        self.dbConn.commit()
+        in_use = "EXISTS (SELECT 1 FROM indicator_values WHERE attribute_id = attribute_action.id)"
+        with self.transaction():
+            self._write("UPDATE attribute_action SET od_field = NULL, source = NULL, target = NULL, action = NULL "
+                        "WHERE attribute = ? AND " + in_use, [(attribute, )])
+            self._write("DELETE FROM attribute_action WHERE attribute = ? AND NOT " + in_use, [(attribute, )])
+        self._reset_attrib_map()
         return
 
+    @timed
     def db_consistency(self):
         """
-        Purpose of this method is to check database consistency. Check that each attribute name in indicators
-        table need to show up in attribute_action table.
+        Purpose of this method is to check database consistency. Check that each attribute in indicator_values table
+        is a registered attribute in attribute_action table: the attribute_action record exists and has a source.
+        Attributes for which the attribute_action record is missing are reported as #<attribute ID>.
         Then check if attributes in attribute_action table occur more than once.
-        :return:
+        :return: ConsistencyReport object.
         """
-        query = "SELECT distinct attribute FROM indicators"
+        query = "SELECT coalesce(a.attribute, '#' || v.attribute_id), count(*) FROM indicator_values v " \
+                "LEFT JOIN attribute_action a ON a.id = v.attribute_id " \
+                "WHERE a.source IS NULL " \
+                "GROUP BY v.attribute_id " \
+                "ORDER BY 1"
         logging.debug('Query: %s', query)
-        self.cur.execute(query)
-        res = self.cur.fetchall()
-        query = "SELECT attribute FROM attribute_action WHERE attribute = ?"
-        for att_row in res:
-            attribute = att_row[0]
-            logging.debug("Now investigating: %s", attribute)
-            self.cur.execute(query, (attribute,))
-            res = self.cur.fetchall()
-            if len(res) > 1:
-                msg = "Attribute " + attribute + " in indicators table, multiple times in attribute_action."
-            elif len(res) < 1:
-                msg = "Attribute " + attribute + " in indicators table, not in attribute_action table."
-            else:
-                msg = ""
-            if len(msg) > 0:
-                print(msg)
-                logging.error(msg)
-        query = "SELECT count(*) as cnt, attribute from attribute_action " \
-                "group by attribute " \
-                "having cnt > 1 " \
-                "order by cnt desc"
-        self.cur.execute(query)
-        res = self.cur.fetchall()
-        for cnt, att in res:
-            msg = "Attribute " + att + " occurs " + str(cnt) + " times in attribute_action Table"
-            print(msg)
-            logging.error(msg)
-        return
+        orphans = self.dbConn.execute(query).fetchall()
+        for attribute, cnt in orphans:
+            logging.error("Attribute %s in indicators table (%s records), not registered in attribute_action table.",
+                          attribute, cnt)
+        query = "SELECT attribute, count(*) AS cnt FROM attribute_action " \
+                "GROUP BY attribute " \
+                "HAVING cnt > 1 " \
+                "ORDER BY cnt DESC"
+        logging.debug('Query: %s', query)
+        duplicates = self.dbConn.execute(query).fetchall()
+        for attribute, cnt in duplicates:
+            logging.error("Attribute %s occurs %s times in attribute_action Table", attribute, cnt)
+        return ConsistencyReport(orphans, duplicates)
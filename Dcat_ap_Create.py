@@ -17,7 +17,7 @@ modulename = my_env.get_modulename(__file__)
 config = my_env.get_inifile(projectname, __file__)
 my_log = my_env.init_loghandler(config, modulename)
 my_log.info('Start Application')
-ds = Datastore(config)
+ds = Datastore(config, read_only=True)
 store = config['xmlns']['store']
 lang = {'xml:lang': 'nl'}
 
@@ -123,21 +123,30 @@ contact_name.text = config['dcat_ap']['contact_name']
 contact_email = SubElement(contact_obj, 'vcard:hasEmail', attrib={'rdf:resource': config['OpenData']['author_email']})
 
 # Find and create the Dataset objects in the profile.
-for indic_id in ds.get_indicator_ids():
+# Get all attributes for all published indicators in one query.
+snapshot = ds.get_indicator_snapshot(ds.get_indicator_ids())
+# First publication (issued) and last change (modified) of each indicator.
+timestamps = ds.get_indicator_timestamps()
+for indic_id, indic_attribs in snapshot.items():
     dataset_uri = store + 'dataset' + my_env.get_dataset_id(indic_id)
     # Initialize dataset object
     dataset_obj = SubElement(root, 'dcat:Dataset', attrib={'rdf:about': dataset_uri})
     # Add dataset to Catalog object
     dcat_dataset = SubElement(catalog_obj, 'dcat:dataset', attrib={'rdf:resource': dataset_uri})
     # Add dataset attributes
-    ind_modified = ds.get_indicator_val(indic_id, 'FicheBijgewerkt')[0:10]
+    ind_modified = indic_attribs.get('FicheBijgewerkt', 'niet gevonden')[0:10]
+    ind_issued = ind_modified
+    first_seen, last_change = timestamps.get(indic_id, (None, None))
+    if first_seen:
+        ind_issued = datetime.fromtimestamp(first_seen).strftime("%Y-%m-%d")
+    if last_change:
+        ind_modified = datetime.fromtimestamp(last_change).strftime("%Y-%m-%d")
     dataset_mod = SubElement(dataset_obj, 'dcterms:modified', attrib={'dcterms:date': ind_modified})
-    # Todo - Add created time to indicators table
-    dataset_issued = SubElement(dataset_obj, 'dcterms:issued', attrib={'dcterms:date': ind_modified})
+    dataset_issued = SubElement(dataset_obj, 'dcterms:issued', attrib={'dcterms:date': ind_issued})
     dataset_title = SubElement(dataset_obj, 'dcterms:title', **lang)
-    dataset_title.text = ds.get_indicator_val(indic_id, 'title')
+    dataset_title.text = indic_attribs.get('title', 'niet gevonden')
     dataset_desc = SubElement(dataset_obj, 'dcterms:description', **lang)
-    dataset_desc.text = ds.get_indicator_val(indic_id, 'notes')
+    dataset_desc.text = indic_attribs.get('notes', 'niet gevonden')
     dataset_publ = get_publisher(dataset_obj)
     dataset_contact = get_contactpoint(dataset_obj)
     dataset_lang = get_language(dataset_obj)
@@ -151,18 +160,18 @@ for indic_id in ds.get_indicator_ids():
     # Now handle all distributions
     for distr in my_env.get_resource_types():
         distr_url_attr = 'url_' + distr
-        if ds.get_indicator_value(indic_id, distr_url_attr):
+        if distr_url_attr in indic_attribs:
             # Distribution exist for this resource type
             distr_uri = store + distr + my_env.get_dataset_id(indic_id)
             distr_obj = SubElement(root, 'dcat:Distribution', attrib={'rdf:about': distr_uri})
             dataset_distr = SubElement(dataset_obj, 'dcat:distribution', attrib={'rdf:resource': distr_uri})
-            distr_loc = ds.get_indicator_val(indic_id, distr_url_attr)
+            distr_loc = indic_attribs[distr_url_attr]
             distr_url = SubElement(distr_obj, 'dcat:accessURL', attrib={'rdf:resource': distr_loc})
             distr_lic = get_license(distr_obj)
             distr_format = SubElement(distr_obj, 'dcterms:format')
-            distr_format.text = ds.get_indicator_val(indic_id, 'format_' + distr)
+            distr_format.text = indic_attribs.get('format_' + distr, 'niet gevonden')
             distr_desc = SubElement(distr_obj, 'dcterms:description', **lang)
-            distr_desc.text = ds.get_indicator_val(indic_id, 'description_' + distr)
+            distr_desc.text = indic_attribs.get('description_' + distr, 'niet gevonden')
 
 # Write the profile contents to file
 res = ElementTree(element=root)
@@ -0,0 +1,25 @@
+#!/opt/csw/bin/python3
+
+"""
+This script will dump the database into a text file with SQL statements. Use LoadDatabase.py to load the file in a
+new database on another host.
+The dump file is option dumpfile in section Main (default dump.sql), use extension .gz for a compressed dump file.
+"""
+
+import sqlite3
+from lib import db_dump
+from lib import my_env
+
+# Initialize Environment
+projectname = "vea_od"
+modulename = my_env.get_modulename(__file__)
+config = my_env.get_inifile(projectname, __file__)
+my_log = my_env.init_loghandler(config, modulename)
+my_log.info('Start Application')
+db = config['Main']['db']
+dumpfile = config['Main'].get('dumpfile', 'dump.sql')
+my_log.info('Get Database connection')
+con = sqlite3.connect(db)
+db_dump.dump_database(con, dumpfile)
+con.close()
+my_log.info('End Application')
@@ -4,6 +4,7 @@
 This script will find all indicators for which Cognos report is not yet available.
 The script will check for Cognos report on vobip public cognos URL.
 If the report is published, then the Cognos URL (for the redirect page) will be added to the indicators table.
+The indicators are evaluated on a read-only datastore, the Cognos URLs are added at the end of the run.
 The script Add_Cognos_Resource.py will then add the resources to Open Data platform.
 
 This script used to be a module in the FileHandler class. But check on Cognos URL failed on Solaris 5.10 with
@@ -22,7 +23,9 @@ modulename = my_env.get_modulename(__file__)
 config = my_env.get_inifile(projectname, __file__)
 my_log = my_env.init_loghandler(config, modulename)
 my_log.info('Start Application')
-ds = Datastore(config)
+ds = Datastore(config, read_only=True)
+# Cognos URLs to add, written in one transaction when all indicators are evaluated.
+cognos_urls = {}
 for indic_id in ds.get_indicator_ids():
     if not ds.check_resource(indic_id, "cognos"):
         indicatorname = ds.get_indicator_value(indic_id, "title")[0][0]
@@ -34,5 +37,10 @@ for indic_id in ds.get_indicator_ids():
             redirect_file, redirect_url = pc_url.redirect2cognos_page(indic_id, config)
             # Add Cognos URL to indicators table. Cognos Resource ID (id_cognos) is not available as long as package
             # has not been created.
-            ds.insert_indicator(indic_id, 'url_cognos', redirect_url)
+            cognos_urls[indic_id] = {'url_cognos': redirect_url}
+ds.close_connection()
+if cognos_urls:
+    ds = Datastore(config)
+    ds.upsert_indicators(cognos_urls)
+    ds.close_connection()
 my_log.info("End Application")
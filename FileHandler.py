@@ -8,25 +8,69 @@ on Open Data platform public.
 2. 'cijfersTable': HTML table representation of the Cijfers file. Optional.
 3. 'commentaar': XML representation of the Commentaar file. Optional.
 Apart from above 3 resources, the PublicCognos is handled as an additional resource without input file.
+Files are handled per indicator. With option workers in section Main larger than 1, indicators are handled in parallel,
+each worker thread has its own FTP and CKAN connection.
+Method watch handles the files as soon as they arrive in the scan directory.
+Each run of process_input_directory writes a run report with the time and bytes per stage (move, hash, FTP, database,
+CKAN, metadata parse), see option run_report in section Main.
 """
 
 import logging
 import os
 import re
 import sys
+import threading
+import time
 import xml.etree.ElementTree as Et
+from concurrent.futures import ThreadPoolExecutor
 from CKANConnector import CKANConnector
 from Datastore import Datastore
 from Ftp_Handler import Ftp_Handler
 from lib import my_env
+from lib import timing
+from lib.dir_watch import DirWatcher
 
 
 class FileHandler:
     def __init__(self, config):
         self.config = config
         self.ds = Datastore(config)
-        self.ckan = CKANConnector(self.config, self.ds)
-        self.ftp = Ftp_Handler(self.config)
+        # FTP and CKAN connections per thread, see properties ftp and ckan.
+        self.local = threading.local()
+        self.conn_lock = threading.Lock()
+        self.ftp_handlers = []
+        # Files that are not published again because the content did not change, and their total size.
+        self.unchanged = {'files': 0, 'bytes': 0}
+        # Time and bytes per stage and per file for the run report, see process_input_directory.
+        self.stats = timing.TimingStats()
+        # Intake journal records of files from an earlier run that are not completely handled, see
+        # process_input_directory.
+        self.resume = {}
+        self.local.ckan = CKANConnector(self.config, self.ds)
+        self.local.ftp = Ftp_Handler(self.config)
+
+    @property
+    def ckan(self):
+        """
+        CKAN connection for the current thread.
+        :return: CKANConnector object.
+        """
+        if getattr(self.local, 'ckan', None) is None:
+            self.local.ckan = CKANConnector(self.config, self.ds)
+        return self.local.ckan
+
+    @property
+    def ftp(self):
+        """
+        FTP connection for the current thread. FTP connections of worker threads are closed at the end of
+        process_input_directory.
+        :return: Ftp_Handler object.
+        """
+        if getattr(self.local, 'ftp', None) is None:
+            self.local.ftp = Ftp_Handler(self.config)
+            with self.conn_lock:
+                self.ftp_handlers.append(self.local.ftp)
+        return self.local.ftp
 
     def url_in_db(self, file):
         """
@@ -38,9 +82,9 @@ class FileHandler:
         logging.debug('Add/Remove file %s to indicators table.', file)
         indic_id = my_env.indic_from_file(file)
         attribute = my_env.attr_from_file('url', file)
-        # Always remove attribute for this indicator. Then no insert / update logic is required.
-        self.ds.remove_indicator_attribute(indic_id, attribute)
-        if 'empty' not in file:
+        if 'empty' in file:
+            self.ds.remove_indicator_attribute(indic_id, attribute)
+        else:
             # Calculate URL
             ftp_home = self.config['FTPServer']['ftp_home']
             # Add FTP Subdirectory (if any)
@@ -50,29 +94,26 @@ class FileHandler:
             else:
                 dirname = ''
             url = ftp_home + '/' + dirname + file
-            # Add URL to indicator table.
-            self.ds.insert_indicator(indic_id, attribute, url)
+            # Add URL to indicator table, replacing the previous URL.
+            self.ds.upsert_indicator_attributes(indic_id, {attribute: url})
         return
 
-    def size_of_file(self, handledir, file):
+    def size_of_file(self, file, size=None):
         """
         Remove the size attribute for this resource.
-        If file does not contain 'empty', then calculate Size of the file and set result in indicators table.
-        :param handledir: Current directory of the file.
+        If file does not contain 'empty', then set the size of the file in indicators table.
         :param file:
+        :param size: Size of the file in bytes, as counted when the file was loaded on the FTP site.
         :return:
         """
         logging.debug('Add/Remove filesize %s to indicators table.', file)
         indic_id = my_env.indic_from_file(file)
         attribute = my_env.attr_from_file('size', file)
-        # Always remove attribute for this indicator. Then no insert / update logic is required.
-        self.ds.remove_indicator_attribute(indic_id, attribute)
-        if 'empty' not in file:
-            # Calculate size of file
-            filename = os.path.join(handledir, file)
-            size = os.path.getsize(filename)
-            # Add size of file to indicator table.
-            self.ds.insert_indicator(indic_id, attribute, size)
+        if 'empty' in file:
+            self.ds.remove_indicator_attribute(indic_id, attribute)
+        else:
+            # Add size of file to indicator table, replacing the previous size.
+            self.ds.upsert_indicator_attributes(indic_id, {attribute: size})
         return
 
     def load_metadata(self, metafile, indic_id):
@@ -87,74 +128,70 @@ class FileHandler:
 
         :param indic_id: Indicator ID
 
-        :return:
+        :return: True if the metadata is loaded and the package is updated, False if the package update failed, None if
+        the file cannot be parsed.
         """
         # TODO: Add URL for 'bijsluiter' to database
         log_msg = "In load_metadata for file " + metafile
         logging.debug(log_msg)
-        try:
-            tree = Et.parse(metafile)
-        except:  # catch all errors for now, try to be more specific in the future.
-            e = sys.exc_info()[1]
-            ec = sys.exc_info()[0]
-            log_msg = "Error during parsing metafile xml: %s %s"
-            logging.critical(log_msg, e, ec)
+        if not self.load_metadata_attributes(metafile, indic_id):
+            return
+        return self.update_metadata_package(indic_id)
+
+    def load_metadata_attributes(self, metafile, indic_id):
+        """
+        Read the file with metadata and replace the information from Dataroom in table indicators.
+        :param metafile: pointer to the file with metadata.
+        :param indic_id: Indicator ID
+        :return: True if the metadata is loaded, None if the file cannot be parsed.
+        """
+        metadata = self._parse_metadata_file(metafile)
+        if metadata is None:
             return
-        root = tree.getroot()
+        self._store_metadata_attributes(metafile, indic_id, *metadata)
+        return True
+
+    def _parse_metadata_file(self, metafile):
+        """
+        Internal method to read the attributes from a metadata file. The file is parsed before a database transaction
+        is started, so the database is not locked during the parse.
+        :param metafile: pointer to the file with metadata.
+        :return: (attributes dictionary, list of Dataroom attribute names), None if the file cannot be parsed.
+        """
         # metadata is available, get list of attributes from Dataroom Application and required for Dataset Page.
-        # First collect all attribute names in list attrib_names.
-        attrib_names = []
-        attribs = self.ds.get_attribs_source('Dataroom')
-        for row in attribs:
-            attrib_names.append(row[0])
-        # Then remove information from Dataroom for Dataset for this indicator ID.
-        for attrib_name in attrib_names:
-            self.ds.remove_indicator_attribute(indic_id, attrib_name)
-        # indicatorname = ""
-        # Add variable data from indicator metadata xml to indicator table.
-        for child in root:
-            # First get child text
-            if child.text:
-                child_text = child.text.strip()
-            else:
-                # Metadata entry does not have a value (key only).
-                child_text = '(niet ingevuld)'
-            # Then see how to handle this text depending on the attribute
-            if child.tag in attrib_names:
-                # Metadata entry exists as an attribute
-                self.ds.insert_indicator(indic_id, child.tag, child_text)
-                # Some metadata fields will be used more than once in Open Data set.
-                # The 'notes' field is a copy of 'definitie'.
-                if child.tag.lower() == 'definitie':
-                    self.ds.insert_indicator(indic_id, 'notes', child_text)
-            # The 'title' field will be used for all Dataset and all resources and gets special threatment.
-            elif child.tag.lower() == 'title':
-                # Set Title for cijfers, commentaar and Cognos report (to do).
-                indicatorname = child_text
-                name_cijfersxml = child_text + " - cijfers (XML)"
-                name_cijferstable = child_text + " - cijfers (Tabel)"
-                name_commentaar = child_text + " - commentaar"
-                name_cognos = indicatorname + " - cognos"
-                self.ds.insert_indicator(indic_id, 'title', indicatorname)
-                self.ds.insert_indicator(indic_id, 'name_cijfersxml', name_cijfersxml)
-                self.ds.insert_indicator(indic_id, 'name_commentaar', name_commentaar)
-                self.ds.insert_indicator(indic_id, 'name_cijferstable', name_cijferstable)
-                self.ds.insert_indicator(indic_id, 'name_cognos', name_cognos)
-            elif child.tag != 'id':
-                log_msg = "Found Dataroom Attribute **" + child.tag + "** not required for Open Data Dataset"
-                logging.warning(log_msg)
-
-        # Add fixed information from 'OpenData' section in Config file to indicator table.
-        additional_attribs = ['description_cijfersxml', 'format_cijfersxml', 'tdt_cijfersxml',
-                              'description_cijferstable', 'format_cijferstable', 'tdt_cijferstable',
-                              'description_commentaar', 'format_commentaar', 'tdt_commentaar',
-                              'description_cognos', 'format_cognos', 'tdt_cognos',
-                              'bijsluiter', 'dcat_ap_profile', 'license_id',
-                              'author_name', 'author_email', 'maintainer_name', 'maintainer_email',
-                              'language']
-        for add_attrib in additional_attribs:
-            self.ds.insert_indicator(indic_id, add_attrib, self.config['OpenData'][add_attrib])
+        attrib_names = [row[0] for row in self.ds.get_attribs_source('Dataroom')]
+        with self.stats.stage('metadata_parse', os.path.getsize(metafile), os.path.basename(metafile)):
+            indic_attribs = self.read_metadata(metafile, attrib_names)
+        if indic_attribs is None:
+            return
+        return indic_attribs, attrib_names
+
+    def _store_metadata_attributes(self, metafile, indic_id, indic_attribs, attrib_names):
+        """
+        Internal method to replace the information from Dataroom in table indicators with the attributes of a metadata
+        file.
+        :param metafile: pointer to the file with metadata.
+        :param indic_id: Indicator ID
+        :param indic_attribs: Dictionary with attribute name as key and value, see read_metadata.
+        :param attrib_names: List of attribute names from Dataroom.
+        :return:
+        """
+        # Fixed information from 'OpenData' section in Config file is not stored for the indicator, the Datastore uses
+        # the config values as catalog defaults.
+
+        # Replace information from Dataroom for Dataset for this indicator ID in one transaction: attributes that are
+        # no longer in the metadata file are removed.
+        with self.stats.stage('db_write', item=os.path.basename(metafile)):
+            self.ds.replace_indicator_attributes(indic_id, indic_attribs, attrib_names)
+        return
 
+    def update_metadata_package(self, indic_id):
+        """
+        Update the dataset on Open Data platform with the information in table indicators, if the dataset exists.
+        :param indic_id: Indicator ID
+        :return: True if the package is updated or if there is no package to update, False if the package update
+        failed.
+        """
         # Now check if dataset exist already: is there an ID available in the indicators table for this indicator.
         values_lst = self.ds.get_indicator_value(indic_id, 'id')
         upd_pkg = "NOK"
@@ -170,81 +207,551 @@ class FileHandler:
             log_msg = "Multiple Open Data dataset links found for Indicator ID %s, please review"
             logging.warning(log_msg, indic_id)
         if upd_pkg == "OK":
-            self.ckan.update_package(indic_id)
+            with self.stats.stage('ckan'):
+                return self.ckan.update_package(indic_id)
         return True
 
-    def process_input_directory(self):
+    @staticmethod
+    def read_metadata(metafile, attrib_names):
+        """
+        Read the attributes from a metadata file. The file is parsed as a stream (iterparse): each attribute element
+        is cleared when it is handled, so memory use does not depend on the size of the file.
+        The attributes are validated: elements that are not Dataroom attributes (or title) are ignored with a warning,
+        and nested elements are ignored. If an attribute occurs more than once, the last value is used.
+        :param metafile: pointer to the file with metadata.
+        :param attrib_names: List of attribute names from Dataroom.
+        :return: Dictionary with attribute name as key and value, None if the file cannot be parsed.
+        """
+        indic_attribs = {}
+        depth = 0
+        root = None
+        try:
+            for event, elem in Et.iterparse(metafile, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        root = elem
+                    continue
+                depth -= 1
+                if depth != 1:
+                    if depth > 1:
+                        log_msg = "Nested element **%s** in metadata file %s ignored"
+                        logging.warning(log_msg, elem.tag, metafile)
+                    continue
+                # Attribute element: first get child text
+                if elem.text:
+                    child_text = elem.text.strip()
+                else:
+                    # Metadata entry does not have a value (key only).
+                    child_text = '(niet ingevuld)'
+                # Then see how to handle this text depending on the attribute
+                # The 'title' field will be used for all Dataset and all resources and gets special threatment.
+                # Some metadata fields will be used more than once in Open Data set. The 'notes' field (copy of
+                # 'definitie') and the resource names (title with suffix) are derived in the Datastore.
+                if elem.tag in attrib_names:
+                    attribute = elem.tag
+                elif elem.tag.lower() == 'title':
+                    attribute = 'title'
+                else:
+                    attribute = None
+                    if elem.tag != 'id':
+                        log_msg = "Found Dataroom Attribute **" + elem.tag + "** not required for Open Data Dataset"
+                        logging.warning(log_msg)
+                if attribute:
+                    if attribute in indic_attribs:
+                        log_msg = "Attribute %s found more than once in metadata file %s, last value is used"
+                        logging.warning(log_msg, attribute, metafile)
+                    indic_attribs[attribute] = child_text
+                # Handled, release the memory of the element.
+                root.clear()
+        except:  # catch all errors for now, try to be more specific in the future.
+            e = sys.exc_info()[1]
+            ec = sys.exc_info()[0]
+            log_msg = "Error during parsing metafile xml: %s %s"
+            logging.critical(log_msg, e, ec)
+            return None
+        return indic_attribs
+
+    def process_input_directory(self, files=None):
         """
-        Function to scan input directory for new files in groups. First group contains the resource files commentaar,
-        cijfersXML and cijfersTable.
-        The second group of files is the metadata files.
-        In the first group of files, the file is moved first. Then if the file contains string 'empty' then the file
-        is removed from FTP site since it cannot be available for external parties anymore. Then the resource
-        information is removed from CKAN.
+        Function to scan input directory for new files and handle the files per indicator. For each indicator the
+        resource files commentaar, cijfersXML and cijfersTable are handled first, then the metadata file. If there is
+        more than one file for a resource type or for the metadata, only the most recent file is handled.
+        A resource file is moved first. Then if the file contains string 'empty' then the file is removed from FTP site
+        since it cannot be available for external parties anymore. Then the resource information is removed from CKAN.
         If the file is valid information (does not contain string 'empty') then the file is loaded on the FTP site.
         In both cases the size of the file and the url are calculated and handled: added to the database or removed
         from the database if filename contains 'empty'.
-        Then the second group of files is handled: the metadata. The file is moved to first. Then if the dataset exists
-        on the Open Data platform and the string contains 'empty' or cijfersxml does not exist, then the update_package
-        method is called to display the package as private on Open Data.
+        A metadata file is moved first. Then if the dataset exists on the Open Data platform and the string contains
+        'empty' or cijfersxml does not exist, then the update_package method is called to display the package as
+        private on Open Data.
         Else (the dataset does not yet exist or cijfersxml does exist so a dataset package mmust be created) the
         load_metadata method is called.
+        Indicators are handled in parallel by option workers (section Main, default 1) threads.
+        The steps for each file are registered in the intake journal. Files that were moved to handledir in an
+        earlier run but not completely handled (e.g. the run stopped on an FTP error) are handled again, starting
+        from the first step that was not done.
+        The time and bytes per stage are written in a JSON run report, option run_report in section Main (default
+        vea_od_run.json in logdir), and in the Prometheus text file format if option run_report_prom is set.
+
+        :param files: Filenames in scandir to handle, default all files in scandir.
 
         :return:
         """
-        # Get ckan connection first
         scandir = self.config['Main']['scandir']
-        handledir = self.config['Main']['handledir']
+        workers = int(self.config['Main'].get('workers', '1'))
+        run_start = time.time()
+        self.stats = timing.TimingStats()
+        self.unchanged = {'files': 0, 'bytes': 0}
         log_msg = "Scan %s for files"
         logging.debug(log_msg, scandir)
         # Don't use os.listdir in for loop since I'll move files. For loop will get confused.
         # Extract filelist first for cijfersXML, cijfersTable or commentaar types. Cognos is also known as
         # resource type, but no files expected so no problem in leaving this.
         type_list = my_env.get_resource_types()
-        filelist = [file for file in os.listdir(scandir) if my_env.type_from_file(file) in type_list]
+        if files is None:
+            files = os.listdir(scandir)
+        else:
+            files = [file for file in files if os.path.isfile(os.path.join(scandir, file))]
+        # Files from an earlier run that were not completely handled, unless a new version of the file arrived.
+        handledir = self.config['Main']['handledir']
+        resume = {}
+        for row in self.ds.get_open_intake():
+            if row[0] in files:
+                self.ds.set_intake_state(row[0], row[1], 'replaced', complete=True)
+            elif os.path.isfile(os.path.join(handledir, row[0])):
+                resume[row[0]] = row
+            else:
+                logging.warning("File %s from an earlier run not found in %s.", row[0], handledir)
+                self.ds.set_intake_state(row[0], row[1], 'missing', complete=True)
+        if resume:
+            logging.info("Resume %s files from an earlier run.", len(resume))
+        self.resume = resume
+        files = list(files) + list(resume)
+        res_files = [file for file in files if my_env.type_from_file(file) in type_list]
+        meta_files = [file for file in files if 'metadata' in file]
+        if meta_files:
+            # At least one update, so set flag for dcat_ap create. If any change then new metafile is required,
+            # so no need to have create for resource files.
+            open(os.path.join(scandir, "dcat_ap_create"), 'w').close()
+        # Files per indicator, resource files before metadata files.
+        indic_files = {}
+        for file in res_files + meta_files:
+            indic_files.setdefault(my_env.indic_from_file(file), []).append(file)
+        if workers <= 1 or len(indic_files) <= 1:
+            for indic_id, filelist in indic_files.items():
+                self._process_indicator(indic_id, filelist)
+        else:
+            logging.info("Handle %s indicators with %s workers", len(indic_files), workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._process_indicator_worker, indic_id, filelist)
+                           for indic_id, filelist in indic_files.items()]
+                for future in futures:
+                    future.result()
+            with self.conn_lock:
+                ftp_handlers = self.ftp_handlers
+                self.ftp_handlers = []
+            for ftp in ftp_handlers:
+                ftp.close_connection()
+        log_msg = "%s unchanged files not published again, %s bytes avoided."
+        logging.info(log_msg, self.unchanged['files'], self.unchanged['bytes'])
+        self._write_run_report(run_start, len(files))
+        return
+
+    def _write_run_report(self, run_start, file_cnt):
+        """
+        Internal method to log the time per stage of the run and to write the run report (JSON and, if option
+        run_report_prom is set, Prometheus text file format). An error writing the report is logged, the run is not
+        affected.
+        :param run_start: Start time of the run (epoch).
+        :param file_cnt: Number of files handled in the run.
+        :return:
+        """
+        duration = time.time() - run_start
+        stats = self.stats.summary()
+        for name in sorted(stats, key=lambda n: stats[n]['total'], reverse=True):
+            st = stats[name]
+            log_msg = "Stage %s: %s calls, total %.3f s, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, %s bytes"
+            logging.info(log_msg, name, st['count'], st['total'], st['p50'] * 1000, st['p95'] * 1000,
+                         st['p99'] * 1000, st['bytes'])
+        logdir = self.config['Main']['logdir']
+        report = self.config['Main'].get('run_report', os.path.join(logdir, 'vea_od_run.json'))
+        prom_report = self.config['Main'].get('run_report_prom')
+        try:
+            timing.write_json_report(report, self.stats, start=run_start, duration=duration, files=file_cnt,
+                                     unchanged_files=self.unchanged['files'], unchanged_bytes=self.unchanged['bytes'])
+            if prom_report:
+                timing.write_prometheus_report(prom_report, self.stats, 'vea_od', run_start_seconds=int(run_start),
+                                               run_duration_seconds=round(duration, 3), run_files=file_cnt,
+                                               run_unchanged_files=self.unchanged['files'],
+                                               run_unchanged_bytes=self.unchanged['bytes'])
+        except OSError:
+            e = sys.exc_info()[1]
+            ec = sys.exc_info()[0]
+            log_msg = "Run report could not be written: %s %s"
+            logging.error(log_msg, e, ec)
+        return
+
+    def _process_indicator_worker(self, indic_id, filelist):
+        """
+        Internal method to handle the files of an indicator in a worker thread. The database connection of the thread
+        is returned to the pool when done.
+        :param indic_id: Indicator ID.
+        :param filelist: Files for the indicator, in the order to handle them.
+        :return:
+        """
+        try:
+            self._process_indicator(indic_id, filelist)
+        finally:
+            self.ds.release_connection()
+        return
+
+    def _process_indicator(self, indic_id, filelist):
+        """
+        Internal method to handle the files of an indicator. Only the final state of each resource type and of the
+        metadata is applied: if there is more than one file for a resource type (e.g. an 'empty' file and a new file),
+        then the most recent file is handled and the other files are only moved. Size and URL of all resource files are
+        written in one transaction with the file manifest, after the FTP and CKAN operations.
+        Files with the same content as the last published version (file manifest) are only moved. The metadata is
+        loaded again only if the metadata file or a resource file has changed.
+        Each step is registered in the intake journal. Resource files: moved, uploaded (loaded on or removed from FTP
+        site) and db-updated (size, URL and manifest, the last step). Metadata files: moved, db-updated (attributes)
+        and ckan-synced (the last step). Files from an earlier run continue after their last step.
+        :param indic_id: Indicator ID.
+        :param filelist: Files for the indicator, in the order to handle them.
+        :return:
+        """
+        logging.debug("Handle files %s for indicator %s", filelist, indic_id)
+        with self.stats.stage('indicator'):
+            self._process_indicator_files(indic_id, filelist)
+        return
+
+    def _process_indicator_files(self, indic_id, filelist):
+        """
+        Internal method to handle the files of an indicator, see _process_indicator.
+        :param indic_id: Indicator ID.
+        :param filelist: Files for the indicator, in the order to handle them.
+        :return:
+        """
+        final = self._coalesce_files(filelist)
         for file in filelist:
-            log_msg = "Filename: %s"
-            logging.debug(log_msg, file)
-            my_env.move_file(file, scandir, handledir)  # Move file done in own function, such a hassle...
-            if 'empty' in file:
-                # remove_file handles paths, empty in filename, ...
-                self.ftp.remove_file(file=file)
-                # Strip empty from filename
-                filename = re.sub('empty\.', '', file)
-                indic_id = my_env.indic_from_file(filename)
-                res_type = my_env.type_from_file(filename)
-                self.ckan.remove_resource(indic_id, res_type)
+            if file not in final.values():
+                log_msg = "File %s is replaced by a more recent file for indicator %s, move only."
+                logging.info(log_msg, file, indic_id)
+                if file not in self.resume:
+                    self._move_file(file)
+                self.ds.set_intake_state(file, indic_id, 'replaced', complete=True)
+        res_files = [file for key, file in final.items() if key != 'metadata']
+        published = {}
+        pending = []
+        for file in res_files:
+            manifest = self._process_resource_file(file)
+            if manifest is False:
+                pending.append(file)
+            elif manifest is not None:
+                published[file] = manifest
+        if published:
+            with self.stats.stage('db_write'), self.ds.transaction():
+                for file, manifest in published.items():
+                    self.size_of_file(file, manifest[1] if manifest else None)
+                    self.url_in_db(file)
+                    if 'empty' in file:
+                        self.ds.remove_manifest(re.sub('empty\.', '', file))
+                    else:
+                        self.ds.set_manifest(file, *manifest)
+                    self.ds.set_intake_state(file, indic_id, 'db-updated', complete=True)
+        if 'metadata' in final:
+            if pending:
+                self._defer_metadata_file(final['metadata'], pending)
             else:
-                self.ftp.load_file(file=os.path.join(handledir, file))
-            self.size_of_file(handledir, file)
-            self.url_in_db(file)
-        # Now handle meta-data
-        filelist = [file for file in os.listdir(scandir) if 'metadata' in file]
+                self._process_metadata_file(final['metadata'], len(published) > 0)
+        return
+
+    def _coalesce_files(self, filelist):
+        """
+        Internal method to find the file that has the final state for each resource type and for the metadata of an
+        indicator. New files win from files of an earlier run, then the most recent file (modification time) wins. For
+        files with the same modification time, a file with content wins from an 'empty' file.
+        :param filelist: Files for the indicator in scandir, or in handledir for files from an earlier run.
+        :return: Dictionary with resource type or 'metadata' as key and filename as value, in the order of filelist.
+        """
+        scandir = self.config['Main']['scandir']
+        handledir = self.config['Main']['handledir']
+
+        def rank(file):
+            if file in self.resume:
+                return False, os.path.getmtime(os.path.join(handledir, file)), 'empty' not in file
+            return True, os.path.getmtime(os.path.join(scandir, file)), 'empty' not in file
+
+        final = {}
         for file in filelist:
-            # At least one update, so set flag for dcat_ap create. If any change then new metafile is required,
-            # so no need to have create in block above.
-            open(os.path.join(scandir, "dcat_ap_create"),'w').close()
-            log_msg = "Filename: %s"
-            logging.debug(log_msg, file)
+            key = 'metadata' if 'metadata' in file else my_env.type_from_file(file)
+            if key in final and rank(file) < rank(final[key]):
+                continue
+            final[key] = file
+        return final
+
+    def _move_file(self, file):
+        """
+        Internal method to move a file from scandir to handledir.
+        :param file: Filename.
+        :return:
+        """
+        scandir = self.config['Main']['scandir']
+        handledir = self.config['Main']['handledir']
+        with self.stats.stage('move', os.path.getsize(os.path.join(scandir, file)), file):
             my_env.move_file(file, scandir, handledir)  # Move file done in own function, such a hassle...
-            # Get indic_id before adding pathname to filename.
-            indic_id = my_env.indic_from_file(file)
-            filename = os.path.join(handledir, file)
-            # Rework logic.
-            # If dataset does not exist, then it needs to be created here (not in load_metadata)
+        return
+
+    def _file_digest(self, filename):
+        """
+        Internal method to get the content hash and the size of a file.
+        :param filename: Filename with path.
+        :return: (sha256, size)
+        """
+        start = time.perf_counter()
+        sha256, size = my_env.get_file_digest(filename)
+        self.stats.record('hash', time.perf_counter() - start, size, os.path.basename(filename))
+        return sha256, size
+
+    def _process_resource_file(self, file):
+        """
+        Internal method to handle a resource file: move the file, then load it on or remove it from the FTP site. Size
+        and url in the indicators table and the file manifest are set by the caller.
+        A file with the same content as the last published version is not loaded again.
+        A file from an earlier run that has been moved is not moved again, a file that has been uploaded is not
+        uploaded again.
+        :param file: Filename of the resource file in scandir.
+        :return: (sha256, size, mtime) of a loaded file, () for an 'empty' file, None if the file did not change, False
+        if loading the file failed.
+        """
+        log_msg = "Filename: %s"
+        logging.debug(log_msg, file)
+        indic_id = my_env.indic_from_file(file)
+        journal = self.resume.get(file)
+        if journal is None:
+            self._move_file(file)
+            self.ds.set_intake_state(file, indic_id, 'moved')
+        elif journal[2] == 'uploaded':
+            logging.info("File %s is uploaded in an earlier run, continue with database update.", file)
+            return tuple(journal[3:6]) if journal[3] else ()
+        result = self._publish_resource_file(file)
+        if result is False:
+            # The file remains in state moved, it is handled again on the next run.
+            return False
+        elif result is None:
+            self.ds.set_intake_state(file, indic_id, 'unchanged', complete=True)
+        else:
+            self.ds.set_intake_state(file, indic_id, 'uploaded', manifest=result)
+        return result
+
+    def _publish_resource_file(self, file):
+        """
+        Internal method to load a resource file in handledir on the FTP site, or to remove the resource for an
+        'empty' file.
+        The file is read only once: size and content hash are calculated while the file is loaded. Size and
+        modification time are compared with the file manifest before, to skip an unchanged file without reading it.
+        :param file: Filename of the resource file.
+        :return: (sha256, size, mtime) of a loaded file, () for an 'empty' file, None if the file did not change, False
+        if loading the file failed.
+        """
+        handledir = self.config['Main']['handledir']
+        if 'empty' in file:
+            # remove_file handles paths, empty in filename, ...
+            with self.stats.stage('ftp_remove', item=file):
+                self.ftp.remove_file(file=file)
+            # Strip empty from filename
+            filename = re.sub('empty\.', '', file)
+            indic_id = my_env.indic_from_file(filename)
+            res_type = my_env.type_from_file(filename)
+            with self.stats.stage('ckan', item=file):
+                self.ckan.remove_resource(indic_id, res_type)
+            return ()
+        filename = os.path.join(handledir, file)
+        st = os.stat(filename)
+        if self._is_unchanged(file, st.st_size, st.st_mtime):
+            return None
+        with self.stats.stage('ftp_upload', st.st_size, file):
+            loaded = self.ftp.load_file(file=filename)
+        if loaded:
+            sha256, size = loaded
+            return sha256, size, st.st_mtime
+        return False
+
+    def _is_unchanged(self, file, size, mtime):
+        """
+        Internal method to check if a file has the same content as the last published version in the file manifest.
+        A file with another size has changed, a file with the same size and modification time has not changed. Only
+        for a file with the same size and another modification time the content hash is calculated.
+        Unchanged files are counted for the report at the end of process_input_directory.
+        :param file: Filename without path, the key in the file manifest. The file is in handledir.
+        :param size: Size of the file in bytes.
+        :param mtime: Modification time of the file, compared in whole seconds like in the manifest.
+        :return: True if the content is the same as the last published version, False otherwise.
+        """
+        manifest = self.ds.get_manifest(file)
+        if manifest is None or manifest[1] != size:
+            return False
+        if manifest[2] != int(mtime):
+            sha256, size = self._file_digest(os.path.join(self.config['Main']['handledir'], file))
+            if sha256 != manifest[0]:
+                return False
+        logging.info("File %s has not changed since last publication, not published again.", file)
+        with self.conn_lock:
+            self.unchanged['files'] += 1
+            self.unchanged['bytes'] += size
+        return True
+
+    def _defer_metadata_file(self, file, pending):
+        """
+        Internal method to handle a metadata file when resource files of the indicator could not be published. The
+        file is moved but not loaded: it remains in the intake journal and is handled in the next run, after the
+        resource files.
+        :param file: Filename of the metadata file in scandir.
+        :param pending: Resource files of the indicator that are not completely handled.
+        :return:
+        """
+        indic_id = my_env.indic_from_file(file)
+        log_msg = "Resource files %s not published, metadata file %s is handled in the next run."
+        logging.warning(log_msg, pending, file)
+        if file not in self.resume:
+            self._move_file(file)
+            self.ds.set_intake_state(file, indic_id, 'moved')
+        return
+
+    def _process_metadata_file(self, file, res_changed=True):
+        """
+        Internal method to handle a metadata file: move the file, then set the package private or load the metadata.
+        Nothing is done if the metadata file has the same content as the last loaded version and no resource file of
+        the indicator has changed.
+        A file from an earlier run that has been moved is not moved again, for a file that has been loaded in the
+        database only the package on Open Data platform is updated.
+        If an update on Open Data platform fails, the file remains incomplete in the intake journal and the file
+        manifest is not updated, so the file is handled again in the next run.
+        :param file: Filename of the metadata file in scandir.
+        :param res_changed: True if a resource file of the indicator has been published in this run.
+        :return:
+        """
+        handledir = self.config['Main']['handledir']
+        log_msg = "Filename: %s"
+        logging.debug(log_msg, file)
+        # Get indic_id before adding pathname to filename.
+        indic_id = my_env.indic_from_file(file)
+        filename = os.path.join(handledir, file)
+        journal = self.resume.get(file)
+        if journal is None:
+            self._move_file(file)
+            self.ds.set_intake_state(file, indic_id, 'moved')
+        elif journal[2] == 'db-updated':
+            logging.info("File %s is loaded in an earlier run, continue with package update.", file)
+            if not self.update_metadata_package(indic_id):
+                return
+            with self.ds.transaction():
+                self.ds.set_manifest(file, *journal[3:6])
+                self.ds.set_intake_state(file, indic_id, 'ckan-synced', complete=True)
+            return
+        if 'empty' not in file and not res_changed:
+            st = os.stat(filename)
+            if self._is_unchanged(file, st.st_size, st.st_mtime):
+                self.ds.set_intake_state(file, indic_id, 'unchanged', complete=True)
+                return
+        # Rework logic.
+        # If dataset does not exist, then it needs to be created here (not in load_metadata)
+        with self.stats.stage('ckan', item=file):
             if not self.ckan.check_dataset(indic_id):
-                self.ckan.create_package(indic_id)
+                if not self.ckan.create_package(indic_id):
+                    return
             # If cijfersxml does not exist or metadata file has empty string, then set package to private.
-            if 'empty' in file or not self.ckan.check_resource(indic_id, 'cijfersxml'):
-                # Required and sufficient reason to set package to private.
-                # I'm sure that package ID exist.
-                values_lst = self.ds.get_indicator_value(indic_id, 'id')
-                self.ckan.set_pkg_private(values_lst[0][0])
-            else:
-                # Dataset package does not yet exist or new valid resource file available and cijfersxml exist.
-                self.load_metadata(filename, indic_id)
+            set_private = 'empty' in file or not self.ckan.check_resource(indic_id, 'cijfersxml')
+        if set_private:
+            # Required and sufficient reason to set package to private.
+            # I'm sure that package ID exist.
+            values_lst = self.ds.get_indicator_value(indic_id, 'id')
+            with self.stats.stage('ckan', item=file):
+                if not self.ckan.set_pkg_private(values_lst[0][0]):
+                    return
+            # The next metadata file must be loaded, also if it has the same content as the last loaded version.
+            with self.ds.transaction():
+                self.ds.remove_manifest(re.sub('empty\.', '', file))
+                self.ds.set_intake_state(file, indic_id, 'ckan-synced', complete=True)
+            return
+        # Dataset package does not yet exist or new valid resource file available and cijfersxml exist.
+        manifest = self._file_digest(filename) + (os.path.getmtime(filename),)
+        metadata = self._parse_metadata_file(filename)
+        if metadata is None:
+            self.ds.set_intake_state(file, indic_id, 'failed', complete=True)
+            return
+        with self.ds.transaction():
+            self._store_metadata_attributes(filename, indic_id, *metadata)
+            self.ds.set_intake_state(file, indic_id, 'db-updated', manifest=manifest)
+        if not self.update_metadata_package(indic_id):
+            return
+        with self.ds.transaction():
+            self.ds.set_manifest(file, *manifest)
+            self.ds.set_intake_state(file, indic_id, 'ckan-synced', complete=True)
+        return
+
+    def watch(self, after_run=None):
+        """
+        This method handles the files in scandir as soon as they arrive, until the process is stopped. The directory is
+        watched with inotify, or polled if inotify is not available. A file is handled when its size did not change for
+        watch_stable seconds. Files are handled in batches: a batch is processed when no new files arrived for
+        watch_debounce seconds, or watch_max_wait seconds after the first file of the batch. The directory is polled
+        every watch_poll seconds when inotify is not available. (Options in section Main, defaults 2, 5, 60 and 2.)
+        Files that are in scandir already are handled first. An error in a batch is logged and the watch continues, the
+        files of the batch that are still in scandir are handled again with the next batch. If no files arrive for
+        watch_retry seconds (default 300), files of an earlier batch that are still in scandir or that are not
+        completely handled according to the intake journal are handled again.
+        The FTP Server closes idle connections, so the FTP connection is opened again for each batch.
+        :param after_run: Function to call after each batch, e.g. to create the dcat_ap catalog.
+        :return:
+        """
+        scandir = self.config['Main']['scandir']
+        watcher = DirWatcher(scandir, self._is_input_file,
+                             stable_time=float(self.config['Main'].get('watch_stable', '2')),
+                             debounce=float(self.config['Main'].get('watch_debounce', '5')),
+                             max_wait=float(self.config['Main'].get('watch_max_wait', '60')),
+                             poll_interval=float(self.config['Main'].get('watch_poll', '2')))
+        retry_interval = float(self.config['Main'].get('watch_retry', '300'))
+        logging.info("Watch %s for files (%s).", scandir, watcher.mode)
+        try:
+            files = watcher.files()
+            while True:
+                retry = []
+                if files or self.ds.get_open_intake():
+                    if files:
+                        logging.info("Handle %s files.", len(files))
+                    else:
+                        logging.info("Retry files that are not completely handled.")
+                    try:
+                        self.ftp.reconnect(self.config)
+                        self.process_input_directory(files)
+                        if after_run:
+                            after_run()
+                    except Exception:
+                        # Keep watching. Files in handledir that are not completely handled are resumed from the intake
+                        # journal, files that are still in scandir are added to the next batch.
+                        e = sys.exc_info()[1]
+                        ec = sys.exc_info()[0]
+                        log_msg = "Error during handling of batch: %s %s"
+                        logging.exception(log_msg, e, ec)
+                        retry = [file for file in files if os.path.isfile(os.path.join(scandir, file))]
+                files = sorted(set(retry + watcher.wait_for_batch(timeout=retry_interval)))
+        except KeyboardInterrupt:
+            logging.info("Watch stopped.")
+        finally:
+            watcher.close()
         return
 
+    @staticmethod
+    def _is_input_file(file):
+        """
+        Internal method to check if a file in scandir is a resource file or a metadata file.
+        :param file: Filename.
+        :return: True for resource files and metadata files, False otherwise.
+        """
+        return my_env.type_from_file(file) in my_env.get_resource_types() or 'metadata' in file
+
     def add_cognos_resources(self):
         """
         This procedure will find all indicators for which Cognos report is available but resource is not published on
@@ -1,11 +1,15 @@
 #!/opt/csw/bin/python3
 
+import hashlib
 import logging
 import os
 import re
 import sys
 from ftplib import FTP
 
+# Block size for reading a file and sending it to the FTP Server.
+blocksize = 1024 * 1024
+
 
 class Ftp_Handler:
 
@@ -85,11 +89,25 @@ class Ftp_Handler:
             logging.debug("FTP Connection closed.")
             return
 
+    def reconnect(self, config_hdl):
+        """
+        Close the FTP Connection and open a new one. The connection is closed without QUIT command, since the FTP
+        Server may have closed an idle connection already.
+        :param config_hdl: Configuration object with the FTPServer section.
+        :return:
+        """
+        self.ftp_hdl.close()
+        self.ftp_hdl = self._ftp_connection(config_hdl)
+        logging.debug("FTP Connection reopened.")
+        return
+
     def load_file(self, file=None):
         """
         Load file on mobielvlaanderen.be. If file exists already, then overwrite.
+        The file is read once, in large blocks: each block is sent to the FTP Server and added to the content hash
+        and the size of the file.
         :param file: Filename (including path) of the file to be loaded.
-        :return:
+        :return: (sha256 hex digest, size in bytes) of the loaded file, False if the file is not loaded.
         """
         log_msg = "Moving file %s to FTP Server"
         logging.debug(log_msg, file)
@@ -97,24 +115,25 @@ class Ftp_Handler:
         (filepath, filename) = os.path.split(file)
         # Load the File
         try:
-            f = open(file, mode='rb')
+            f = DigestReader(open(file, mode='rb', buffering=blocksize))
         except:
             e = sys.exc_info()[0]
             log_msg = "Error to open file %s"
             logging.critical(log_msg, e)
-            return
+            return False
         stor_cmd = 'STOR ' + filename
         try:
-            self.ftp_hdl.storbinary(stor_cmd, f)
+            self.ftp_hdl.storbinary(stor_cmd, f, blocksize=blocksize)
         except:
             e = sys.exc_info()[0]
             log_msg = "Error loading file: %s"
             logging.critical(log_msg, e)
-            return
+            f.close()
+            return False
         log_msg = "Looks like file %s is moved to FTP Server, close file now."
         logging.debug(log_msg, file)
         f.close()
-        return
+        return f.sha256.hexdigest(), f.size
 
     def remove_file(self, file=None):
         """
@@ -141,3 +160,36 @@ class Ftp_Handler:
             log_msg = "Looks like file %s is removed from FTP Server"
             logging.debug(log_msg, filename)
         return
+
+
+class DigestReader:
+
+    """
+    This class wraps a file object that is opened for reading in binary mode. The data that is read is added to a
+    content hash (sha256) and counted, so the hash and the size of a file are known after one read of the file.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        return
+
+    def read(self, size=-1):
+        """
+        Read a block from the file and add it to the content hash and the size.
+        :param size: Maximum number of bytes to read, -1 for the rest of the file.
+        :return: Block of data, empty at end of file.
+        """
+        block = self.f.read(size)
+        self.sha256.update(block)
+        self.size += len(block)
+        return block
+
+    def close(self):
+        """
+        Close the file.
+        :return:
+        """
+        self.f.close()
+        return
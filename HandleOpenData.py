@@ -30,8 +30,11 @@ scandir = config['Main']['scandir']
 dcat_ap_flag = os.path.join(scandir, "dcat_ap_create")
 if os.path.isfile(dcat_ap_flag):
     os.remove(dcat_ap_flag)
+    # Dcat_ap_Create.py reads the database file, write the changes of the write-behind mode first.
+    fh.ds.checkpoint()
     scriptname = 'Dcat_ap_Create.py'
     cmdline = scriptdir + " " + scriptname
     my_log.info("CmdLine: {c}".format(c=cmdline))
     subprocess.call(cmdline)
+fh.ds.close_connection()
 my_log.info("End Application")
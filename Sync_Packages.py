@@ -0,0 +1,30 @@
+#!/opt/csw/bin/python3
+
+"""
+This script will update the packages on Open Data platform for all indicators that have changed in the indicators table
+since the last successful run of this script. Use this script instead of a full resync of all indicators.
+"""
+import os
+from CKANConnector import CKANConnector
+from Datastore import Datastore
+from lib import my_env
+
+# Initialize Environment
+projectname = "vea_od"
+modulename = my_env.get_modulename(__file__)
+config = my_env.get_inifile(projectname, __file__)
+my_log = my_env.init_loghandler(config, modulename)
+my_log.info('Start Application')
+ds = Datastore(config)
+# Check for proxyserver
+try:
+    http_proxy = config['Main']['proxy']
+except KeyError:  # http_proxy not defined, continue
+    pass
+else:
+    os.environ['http_proxy'] = http_proxy
+    my_log.info("Set proxy to %s", http_proxy)
+ckan = CKANConnector(config, ds)
+ckan.sync_changed_packages()
+ds.close_connection()
+my_log.info("End Application")
@@ -0,0 +1,49 @@
+#!/opt/csw/bin/python3
+
+"""
+This script handles the files from Dataroom as soon as they arrive in the scan directory, as an alternative for running
+HandleOpenData.py every cycle from Scheduling.py. The script runs until it is stopped.
+"""
+import os
+import subprocess
+import sys
+from FileHandler import FileHandler
+from lib import my_env
+
+
+def create_dcat_ap():
+    """
+    Load dcat_ap profile for Open Data if flag is set to create dcat_ap.
+    :return:
+    """
+    dcat_ap_flag = os.path.join(config['Main']['scandir'], "dcat_ap_create")
+    if os.path.isfile(dcat_ap_flag):
+        os.remove(dcat_ap_flag)
+        # Dcat_ap_Create.py reads the database file, write the changes of the write-behind mode first.
+        fh.ds.checkpoint()
+        scriptname = 'Dcat_ap_Create.py'
+        cmdline = [sys.executable, scriptname]
+        my_log.info("CmdLine: {c}".format(c=" ".join(cmdline)))
+        subprocess.call(cmdline)
+    return
+
+
+# Initialize Environment
+projectname = "vea_od"
+modulename = my_env.get_modulename(__file__)
+config = my_env.get_inifile(projectname, __file__)
+my_log = my_env.init_loghandler(config, modulename)
+my_log.info('Start Application')
+# Get FileHandler Object
+fh = FileHandler(config)
+# Check for proxyserver
+try:
+    http_proxy = config['Main']['proxy']
+except KeyError:  # http_proxy not defined, continue
+    pass
+else:
+    os.environ['http_proxy'] = http_proxy
+    my_log.info("Set proxy to %s", http_proxy)
+fh.watch(after_run=create_dcat_ap)
+fh.ds.close_connection()
+my_log.info("End Application")
@@ -0,0 +1,111 @@
+"""
+This module has the functions to dump a database to a text file with SQL statements and to load such a file in a new
+database. Both functions stream the statements, so memory use does not depend on the size of the database. This allows
+to migrate the database to another host (e.g. a Solaris environment).
+A dump file with extension .gz is gzip compressed.
+"""
+
+import gzip
+import logging
+import sqlite3
+import time
+
+
+def open_dump(filename, mode):
+    """
+    This function opens a dump file in text mode. Files with extension .gz are gzip compressed.
+    :param filename: Name of the dump file.
+    :param mode: 'r' for read or 'w' for write.
+    :return: File object.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def dump_database(db_conn, filename):
+    """
+    This function writes all statements that are required to rebuild the database into the dump file, one statement
+    at a time. The schema version (PRAGMA user_version) is added at the end, so the Datastore schema upgrades are not
+    applied again on the loaded database.
+    :param db_conn: Connection to the database to dump.
+    :param filename: Name of the dump file.
+    :return: Number of statements written.
+    """
+    logging.info("Dump database to %s", filename)
+    cnt = 0
+    with open_dump(filename, 'w') as f:
+        for statement in db_conn.iterdump():
+            f.write(statement + '\n')
+            cnt += 1
+        f.write("PRAGMA user_version = {v};\n".format(v=db_conn.execute("PRAGMA user_version").fetchone()[0]))
+    logging.info("Dump done, %s statements written.", cnt)
+    return cnt
+
+
+def read_statements(f):
+    """
+    This function reads SQL statements from a dump file. Lines are collected until they form a complete statement,
+    so statements can span more than one line.
+    :param f: File object of the dump file.
+    :return: Generator for the statements.
+    """
+    statement = ''
+    for line in f:
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement.strip()
+            statement = ''
+    if statement.strip():
+        logging.error("Incomplete statement at end of dump file: %s", statement[:80])
+    return
+
+
+def load_database(db_conn, filename, batch_size=10000):
+    """
+    This function loads a dump file in a database. Transaction statements in the dump file are ignored, rows are
+    inserted in transactions of batch_size statements. Indexes and triggers are created after all rows are loaded:
+    building an index once is faster than updating it for each row, and journal triggers must not fire for loaded rows.
+    The load rate (rows per second) is logged after each transaction.
+    :param db_conn: Connection to the new database. The connection is set in autocommit mode.
+    :param filename: Name of the dump file.
+    :param batch_size: Number of statements per transaction.
+    :return: Number of rows loaded.
+    """
+    logging.info("Load database from %s", filename)
+    db_conn.isolation_level = None
+    # Nothing to lose in a new database: no fsync during the load.
+    db_conn.execute("PRAGMA synchronous = OFF")
+    deferred = []
+    rows = 0
+    in_batch = 0
+    start = time.time()
+    with open_dump(filename, 'r') as f:
+        for statement in read_statements(f):
+            keyword = ' '.join(statement.split(None, 2)[:2]).upper()
+            if keyword.startswith('BEGIN') or keyword.startswith('COMMIT') or keyword.startswith('END'):
+                continue
+            if keyword in ['CREATE INDEX', 'CREATE UNIQUE', 'CREATE TRIGGER']:
+                deferred.append(statement)
+                continue
+            if in_batch == 0:
+                db_conn.execute("BEGIN")
+            db_conn.execute(statement)
+            if keyword.startswith('INSERT'):
+                rows += 1
+            in_batch += 1
+            if in_batch >= batch_size:
+                db_conn.execute("COMMIT")
+                in_batch = 0
+                logging.info("%s rows loaded, %.0f rows/s", rows, rows / max(time.time() - start, 0.001))
+    if in_batch > 0:
+        db_conn.execute("COMMIT")
+    logging.info("Create %s indexes and triggers.", len(deferred))
+    db_conn.execute("BEGIN")
+    for statement in deferred:
+        db_conn.execute(statement)
+    db_conn.execute("COMMIT")
+    db_conn.execute("PRAGMA synchronous = FULL")
+    duration = max(time.time() - start, 0.001)
+    logging.info("Load done, %s rows in %.1f seconds (%.0f rows/s).", rows, duration, rows / duration)
+    return rows
@@ -0,0 +1,188 @@
+"""
+This module has the class to watch a directory for new files. On Linux the directory is watched with inotify (through
+ctypes), on other platforms or if inotify is not available the directory is polled with os.scandir.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+# inotify event masks, see /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+event_header = struct.Struct('iIII')
+
+
+class DirWatcher:
+
+    def __init__(self, directory, accept=None, stable_time=2, debounce=5, max_wait=60, poll_interval=2):
+        """
+        Method to instantiate the class in an object to watch a directory.
+        :param directory: Directory to watch.
+        :param accept: Function that gets a filename and returns True for files to watch. Default: all files.
+        :param stable_time: Seconds that size and modification time of a file must remain the same before the file is
+        considered complete.
+        :param debounce: Seconds without new files before a batch is returned.
+        :param max_wait: Maximum seconds between the first file of a batch and the return of the batch.
+        :param poll_interval: Seconds between two scans of the directory if inotify is not available.
+        :return: Object to watch the directory.
+        """
+        self.directory = directory
+        self.accept = accept or (lambda file: True)
+        self.stable_time = stable_time
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        # Files in the directory on the previous scan (polling mode), filename: (size, mtime).
+        self.known = {}
+        self.fd = self._inotify_init()
+        if self.fd is None:
+            self.mode = 'polling'
+            self.known = self._scan()
+        else:
+            self.mode = 'inotify'
+        return
+
+    def _inotify_init(self):
+        """
+        Internal method to start an inotify watch on the directory.
+        :return: inotify file descriptor, None if inotify is not available.
+        """
+        if not sys.platform.startswith('linux'):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (OSError, AttributeError):
+            e = sys.exc_info()[1]
+            ec = sys.exc_info()[0]
+            log_msg = "inotify not available, poll directory instead: %s %s"
+            logging.warning(log_msg, e, ec)
+            return None
+        return fd
+
+    def _scan(self):
+        """
+        Internal method to get the files in the directory.
+        :return: Dictionary with filename as key and (size, mtime) as value.
+        """
+        files = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and self.accept(entry.name):
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def _wait_events(self, timeout):
+        """
+        Internal method to wait for new or changed files.
+        :param timeout: Maximum number of seconds to wait, None to wait until there is an event.
+        :return: Set of filenames that are new or changed.
+        """
+        if self.fd is None:
+            time.sleep(self.poll_interval if timeout is None else min(timeout, self.poll_interval))
+            files = self._scan()
+            changed = set(file for file, stat in files.items() if self.known.get(file) != stat)
+            self.known = files
+            return changed
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        changed = set()
+        buffer = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos + event_header.size <= len(buffer):
+            wd, mask, cookie, length = event_header.unpack_from(buffer, pos)
+            pos += event_header.size
+            name = os.fsdecode(buffer[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                # Events are lost, check all files in the directory.
+                logging.warning("inotify queue overflow, scan directory.")
+                changed.update(self._scan())
+            elif name and self.accept(name):
+                changed.add(name)
+        return changed
+
+    def files(self):
+        """
+        This method returns the files in the directory that are watched.
+        :return: List of filenames.
+        """
+        return list(self._scan())
+
+    def wait_for_batch(self, timeout=None):
+        """
+        This method waits for new files in the directory. A file is added to the batch when its size and modification
+        time did not change for stable_time seconds. The batch is returned when no new files arrived for debounce
+        seconds and all files are stable, or max_wait seconds after the first file of the batch.
+        :param timeout: Seconds to wait for a new file, None to wait until a file arrives.
+        :return: List of filenames in the batch, empty list if no file arrived within timeout seconds.
+        """
+        # Files in the batch: filename: [size, mtime, time of last change]
+        pending = {}
+        first_event = None
+        last_event = None
+        start = time.time()
+        while True:
+            if pending:
+                wait = 0.5
+            elif timeout is None:
+                wait = None
+            else:
+                wait = max(0, start + timeout - time.time())
+            changed = self._wait_events(wait)
+            now = time.time()
+            if changed:
+                last_event = now
+                if first_event is None:
+                    first_event = now
+            for file in changed:
+                pending.setdefault(file, [None, None, now])
+            stable = []
+            for file, state in list(pending.items()):
+                try:
+                    st = os.stat(os.path.join(self.directory, file))
+                except FileNotFoundError:
+                    # File is removed or moved away.
+                    del pending[file]
+                    continue
+                if (st.st_size, st.st_mtime_ns) != (state[0], state[1]):
+                    pending[file] = [st.st_size, st.st_mtime_ns, now]
+                elif now - state[2] >= self.stable_time:
+                    stable.append(file)
+            if not pending:
+                first_event = None
+                if timeout is not None and now - start >= timeout:
+                    return []
+                continue
+            if len(stable) == len(pending) and now - last_event >= self.debounce:
+                return sorted(stable)
+            if stable and now - first_event >= self.max_wait:
+                logging.info("Maximum wait time reached, %s files not yet complete.", len(pending) - len(stable))
+                return sorted(stable)
+
+    def close(self):
+        """
+        This method stops watching the directory.
+        :return:
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        return
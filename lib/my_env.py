@@ -6,6 +6,7 @@ Also other utilities find their home here.
 
 import configparser
 import datetime
+import hashlib
 import logging
 import logging.handlers
 import os
@@ -140,22 +141,22 @@ def move_file(file2move, sourcedir, targetdir):
     return
 
 
-def get_array(inp_obj):
+def get_file_digest(filename):
     """
-    The purpose of the method is to convert input string or input array into a string that can be used in SELECT ...
-    WHERE attribute IN (inp1, inp2, ...)
-    :param inp_obj: String or Array (list). Error on other values. String will be surrounded by quotes. Values in the
-    array will not be surrounded by quotes.
-    :return: string to use in SQL query
+    This function calculates the content hash (sha256) and the size of a file.
+    :param filename: Filename (including path) of the file.
+    :return: (hex digest, size in bytes) tuple.
     """
-    if isinstance(inp_obj, list):
-        outp_obj = str(tuple(inp_obj))
-    elif isinstance(inp_obj, str):
-        outp_obj = "('" + inp_obj + "')"
-    else:
-        logging.error("Input %s cannot be converted, type is %s.", str(inp_obj), type(inp_obj).__name__)
-        outp_obj = ""
-    return outp_obj
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            sha256.update(block)
+            size += len(block)
+    return sha256.hexdigest(), size
 
 
 def indic_from_file(filename):
@@ -232,6 +233,38 @@ def get_resource_type_file():
     return resource_types
 
 
+def get_catalog_default_attribs():
+    """
+    This method will return the attributes that have the same value for all indicators. The values are in the
+    OpenData section of the ini file.
+    :return: array with catalog default attribute names.
+    """
+    default_attribs = ['description_cijfersxml', 'format_cijfersxml', 'tdt_cijfersxml',
+                       'description_cijferstable', 'format_cijferstable', 'tdt_cijferstable',
+                       'description_commentaar', 'format_commentaar', 'tdt_commentaar',
+                       'description_cognos', 'format_cognos', 'tdt_cognos',
+                       'bijsluiter', 'dcat_ap_profile', 'license_id',
+                       'author_name', 'author_email', 'maintainer_name', 'maintainer_email',
+                       'language']
+    return default_attribs
+
+
+def get_derived_attribs():
+    """
+    This method will return the attributes that are calculated from another attribute of the indicator: the resource
+    names are the indicator title with a suffix, notes is a copy of Definitie.
+    :return: dictionary with derived attribute name as key and (source attribute, suffix) as value.
+    """
+    derived_attribs = {
+        'name_cijfersxml': ('title', ' - cijfers (XML)'),
+        'name_cijferstable': ('title', ' - cijfers (Tabel)'),
+        'name_commentaar': ('title', ' - commentaar'),
+        'name_cognos': ('title', ' - cognos'),
+        'notes': ('Definitie', ''),
+    }
+    return derived_attribs
+
+
 def get_target(resource_type):
     """
     This method will return target name as used in table attribute_action for a specific resource type.
@@ -0,0 +1,154 @@
+"""
+This module has the class to collect execution times. The times are collected per name (e.g. a method of the Datastore
+or a stage of the publishing pipeline) and summarized as count, total time and percentiles. The summary can be written
+as a JSON report or in the Prometheus text file format (node exporter textfile collector).
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TimingStats:
+
+    def __init__(self):
+        """
+        Method to instantiate the class in an object to collect execution times. The object can be shared between
+        threads.
+        :return: Object to collect execution times.
+        """
+        self.samples = {}
+        # Bytes handled per name, and seconds and bytes per item (e.g. per file) and name.
+        self.bytes = {}
+        self.items = {}
+        self.lock = threading.Lock()
+        return
+
+    def record(self, name, seconds, nbytes=0, item=None):
+        """
+        This method adds an execution time.
+        :param name: Name of the timed item.
+        :param seconds: Execution time in seconds.
+        :param nbytes: Number of bytes handled.
+        :param item: Item (e.g. filename) the time is for, None if the time is not collected per item.
+        :return:
+        """
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+            self.bytes[name] = self.bytes.get(name, 0) + nbytes
+            if item is not None:
+                totals = self.items.setdefault(item, {}).setdefault(name, {'seconds': 0, 'bytes': 0})
+                totals['seconds'] += seconds
+                totals['bytes'] += nbytes
+        return
+
+    @contextmanager
+    def stage(self, name, nbytes=0, item=None):
+        """
+        This method times the statements in a with block. The time is recorded also if the block raises an exception.
+        :param name: Name of the timed item.
+        :param nbytes: Number of bytes handled in the block.
+        :param item: Item (e.g. filename) the time is for.
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, nbytes, item)
+
+    def summary(self):
+        """
+        This method summarizes the execution times per name.
+        :return: Dictionary with name as key and dictionary with count, total, p50, p95 and p99 (seconds) and bytes as
+        value.
+        """
+        with self.lock:
+            samples = {name: sorted(times) for name, times in self.samples.items()}
+            nbytes = dict(self.bytes)
+        res = {}
+        for name, times in samples.items():
+            res[name] = {'count': len(times),
+                         'total': sum(times),
+                         'bytes': nbytes.get(name, 0),
+                         'p50': percentile(times, 50),
+                         'p95': percentile(times, 95),
+                         'p99': percentile(times, 99)}
+        return res
+
+
+def percentile(times, pct):
+    """
+    This function returns the percentile of a sorted list of values (nearest rank).
+    :param times: Sorted list of values, at least one value.
+    :param pct: Percentile (0 - 100).
+    :return: Value of the percentile.
+    """
+    rank = max(math.ceil(pct / 100 * len(times)), 1)
+    return times[rank - 1]
+
+
+def write_atomic(filename, text):
+    """
+    This function writes a text file through a temporary file in the same directory, so a reader never sees a partial
+    file.
+    :param filename: Name of the file.
+    :param text: Content of the file.
+    :return:
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_file, filename)
+    return
+
+
+def write_json_report(filename, stats, **info):
+    """
+    This function writes the summary of the execution times as a JSON report.
+    :param filename: Name of the report file.
+    :param stats: TimingStats object.
+    :param info: Additional information for the report (e.g. start time, number of files).
+    :return:
+    """
+    with stats.lock:
+        items = {item: {name: dict(totals) for name, totals in names.items()} for item, names in stats.items.items()}
+    report = dict(info)
+    report['stages'] = stats.summary()
+    report['items'] = items
+    write_atomic(filename, json.dumps(report, indent=2, sort_keys=True))
+    return
+
+
+def write_prometheus_report(filename, stats, prefix, **gauges):
+    """
+    This function writes the summary of the execution times in the Prometheus text file format. The execution times
+    are a summary metric <prefix>_stage_seconds with the stage as label, the bytes handled are metric
+    <prefix>_stage_bytes_total.
+    :param filename: Name of the report file, use extension .prom for the node exporter textfile collector.
+    :param stats: TimingStats object.
+    :param prefix: Prefix for the metric names.
+    :param gauges: Additional metrics, name (without prefix) and value.
+    :return:
+    """
+    summary = stats.summary()
+    lines = ["# HELP {p}_stage_seconds Execution time per stage.".format(p=prefix),
+             "# TYPE {p}_stage_seconds summary".format(p=prefix)]
+    for name in sorted(summary):
+        for quantile, key in [('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99')]:
+            lines.append('{p}_stage_seconds{{stage="{n}",quantile="{q}"}} {v:.6f}'
+                         .format(p=prefix, n=name, q=quantile, v=summary[name][key]))
+        lines.append('{p}_stage_seconds_sum{{stage="{n}"}} {v:.6f}'.format(p=prefix, n=name, v=summary[name]['total']))
+        lines.append('{p}_stage_seconds_count{{stage="{n}"}} {v}'.format(p=prefix, n=name, v=summary[name]['count']))
+    lines.append("# HELP {p}_stage_bytes_total Bytes handled per stage.".format(p=prefix))
+    lines.append("# TYPE {p}_stage_bytes_total counter".format(p=prefix))
+    for name in sorted(summary):
+        lines.append('{p}_stage_bytes_total{{stage="{n}"}} {v}'.format(p=prefix, n=name, v=summary[name]['bytes']))
+    for name in sorted(gauges):
+        lines.append("# TYPE {p}_{n} gauge".format(p=prefix, n=name))
+        lines.append("{p}_{n} {v}".format(p=prefix, n=name, v=gauges[name]))
+    write_atomic(filename, '\n'.join(lines) + '\n')
+    return